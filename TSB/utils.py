@@ -9,6 +9,7 @@ This module contains TSB related functions that are not app specific.
 from __future__ import division
 from __future__ import absolute_import
 
+from django.db import transaction
 from django.core.mail import send_mail
 from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
@@ -47,6 +48,40 @@ def get_choice(choices, choice):
     return dict(choices)[choice]
 
 
+def bulk_insert(model, data, key_fields=('stock', 'date'), chunk_size=500):
+    '''
+    Insert the rows in <data> into the table of <model> with a few queries,
+    instead of a get_or_create for every row.
+
+    <data> is a list of dicts with a key for each field of <model>. 
+    <key_fields> are the fields that uniquely identify a record, the first two
+    must be the stock (a ForeignKey) and the date. Rows that already exist in
+    the table (or earlier in <data>) are skipped, they are not overwritten.
+    Existing records are looked up with one query per <chunk_size> stocks.
+
+    Returns a tuple (n_inserted, n_skipped)
+    '''
+    stock_field = key_fields[0]
+    rows = {}
+    for row in data:
+        key = (row[stock_field].id,) + tuple(row[f] for f in key_fields[1:])
+        rows.setdefault(key, row)
+    if rows:
+        stock_ids = sorted(set(key[0] for key in rows))
+        dates = [key[1] for key in rows]
+        for i in range(0, len(stock_ids), chunk_size):
+            existing = model.objects.filter(**{
+                    stock_field + '__in': stock_ids[i:i + chunk_size],
+                    'date__gte': min(dates), 'date__lte': max(dates)}
+                    ).values_list(*key_fields)
+            for key in existing:
+                rows.pop(tuple(key), None)
+    with transaction.commit_on_success():
+        model.objects.bulk_create([model(**row) for row in rows.values()])
+    return len(rows), len(data) - len(rows)
+
+
+
 class Notify():
     '''
     Puts notifications and confirmations in the status bar
@@ -2,7 +2,7 @@ from __future__ import division
 from __future__ import absolute_import
 
 from django.contrib import admin
-from channel.models import Channel
+from channel.models import Channel, ChannelHistory
 
 
 class ChannelAdmin(admin.ModelAdmin):
@@ -13,3 +13,13 @@ class ChannelAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Channel, ChannelAdmin)
+
+
+class ChannelHistoryAdmin(admin.ModelAdmin):
+    list_display = ('stock', 'lookback', 'startdate', 'enddate', 'n_dates')
+    ordering = ('stock', 'lookback')
+    list_filter = ('lookback', 'stock')
+    exclude = ('data',)
+
+
+admin.site.register(ChannelHistory, ChannelHistoryAdmin)
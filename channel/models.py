@@ -8,13 +8,22 @@ Created on 130118
 from __future__ import division
 from __future__ import absolute_import
 
-import math
+import math, datetime, base64
+from decimal import Decimal
+from copy import copy
+from bisect import bisect_left
+from itertools import groupby
+from operator import itemgetter
 
+import numpy as np
+
+from django.conf import settings
 from django.db import models, transaction
 from django.db.models import Max, Min
 
-from pyutillib.math_utils import div
+from TSB.utils import bulk_insert
 from pricemanager.indicators.datedlist import DatedList
+from pricemanager.indicators.tradingcalendar import TradingCalendar
 
 
 
@@ -44,6 +53,13 @@ class Channel(models.Model):
     SIXWEEKS = 31
     MONTH = 21
     LOOKBACKS = (YEAR, SIXMONTHS, QUARTER, TWOMONTHS, SIXWEEKS, MONTH)
+    FIELDS = ('angle', 'width', 'bottom')
+
+    # storage of channel data: one row per stock, date and lookback in this
+    #   table, or one row per stock and lookback in ChannelHistory
+    TABLE = 'table'
+    HISTORY = 'history'
+    storage = getattr(settings, 'CHANNEL_STORAGE', TABLE)
     LOOKBACK_CHOICES = (
             (YEAR, '1 year'),
             (SIXMONTHS, '6 months'),
@@ -71,20 +87,16 @@ class Channel(models.Model):
         for stock in stocklist:
             date = stock.get_latest_date()
             stock.date_range = (date, date)
-            data = []
+            lookbacks = []
             for lookback in cls.LOOKBACKS:
                 if len(stock.price.close) <= lookback:
                     print('skipping {} {} days'.format(stock.name, lookback))
-                    continue
                 else:
                     print stock.name, lookback
-                width, angle, bottom = channel(
-                        stock.price.low[date:-lookback], 
-                        stock.price.high[date:-lookback])
-                data.append({'stock': stock, 'date': date, 'lookback': lookback,
-                        'angle': angle, 'width': width, 'bottom': bottom})
+                    lookbacks.append(lookback)
+            dates, channels = calc_channels_all_lookbacks(stock, lookbacks)
             print 'Writing {} channels to DB...'.format(stock.name)
-            cls._insert_data(data)
+            cls.save_array(stock, lookbacks, dates, channels)
             print 'Written'
         print 'All channels done'
 
@@ -96,6 +108,21 @@ class Channel(models.Model):
         results to the channels table. If start and enddate are not specified, 
         all channel data is calculated.
         '''
+        result = cls.calculate_array(stock, startdate, enddate)
+        print 'Writing {} channels to DB...'.format(stock.name)
+        print 'Written {}, skipped {} existing'.format(*cls.save_array(stock,
+                *result))
+
+
+    @classmethod
+    def calculate_array(cls, stock, startdate=None, enddate=None):
+        '''
+        Calculate channels for a stock in the specified date range (see 
+        calculate), without saving them.
+        Returns a tuple (lookbacks, dates, channels, startdates), see 
+        calc_channels_all_lookbacks. <startdates> is None or a list with the 
+        first date of each lookback.
+        '''
         if startdate is None and enddate is None:
             # Calculate channel parameters for ALL available price data, note
             # that stock.date_range *should* not be set!
@@ -105,22 +132,63 @@ class Channel(models.Model):
         else:
             raise ValueError('startdate and enddate must both have a value or '\
                     'both be None')
+        lookbacks = [lookback for lookback in cls.LOOKBACKS if 
+                len(stock.price.close) > lookback]
+        startdates = None
+        if startdate is None and lookbacks:
+            # start every lookback calculation at the earliest possible time
+            startdates = [stock.price.close.dates[lookback] for lookback in
+                    lookbacks]
+            stock.date_range = (min(startdates), enddate)
+        dates, channels = calc_channels_all_lookbacks(stock, lookbacks)
+        return lookbacks, dates, channels, startdates
+
+
+    @classmethod
+    def save_array(cls, stock, lookbacks, dates, channels, startdates=None):
+        '''
+        Save the result of calc_channels_all_lookbacks for <stock> to the 
+        Channel table or to the ChannelHistory table, depending on 
+        <cls.storage>. Existing channels are not overwritten.
+        If <startdates> is specified, dates before the startdate of a lookback
+        are skipped.
+
+        Returns a tuple (n_inserted, n_skipped)
+        '''
+        if cls.storage != cls.HISTORY:
+            return cls._insert_data(cls._array_data(stock, lookbacks, dates, 
+                    channels, startdates))
+        n_inserted = n_skipped = 0
+        with transaction.commit_on_success():
+            for i_lookback, lookback in enumerate(lookbacks):
+                i_start = 0
+                if startdates is not None:
+                    i_start = bisect_left(dates, startdates[i_lookback])
+                n_i, n_s = ChannelHistory.add(stock, lookback, 
+                        dates[i_start:], channels[i_lookback, i_start:])
+                n_inserted += n_i
+                n_skipped += n_s
+        return n_inserted, n_skipped
+
+
+    @classmethod
+    def _array_data(cls, stock, lookbacks, dates, channels, startdates=None):
+        '''
+        Returns a list of dicts with a key for each <Channel> field (see 
+        _insert_data) from the result of calc_channels_all_lookbacks.
+        If <startdates> is specified, dates before the startdate of a lookback
+        are skipped.
+        '''
         data = []
-        for lookback in cls.LOOKBACKS:
-            if len(stock.price.close) <= lookback:
-                continue
-            if startdate is None:
-                # start every lookback calculation at the earliest possible time
-                stock.date_range = (stock.price.close.dates[lookback], enddate)
-            result = calc_channel(stock, lookback)
-            for date in result['angle'].dates:
+        for i_lookback, lookback in enumerate(lookbacks):
+            i_start = 0
+            if startdates is not None:
+                i_start = bisect_left(dates, startdates[i_lookback])
+            for date, (angle, width, bottom) in zip(dates[i_start:], 
+                    channels[i_lookback, i_start:].tolist()):
                 data.append({'stock': stock, 'date': date, 'lookback': lookback,
-                        'angle': result['angle'][date],
-                        'width': result['width'][date],
-                        'bottom': result['bottom'][date]})
-        print 'Writing {} channels to DB...'.format(stock.name)
-        cls._insert_data(data)
-        print 'Written'
+                        'angle': angle, 'width': width, 'bottom': bottom})
+        return data
 
 
     @classmethod
@@ -129,14 +197,11 @@ class Channel(models.Model):
         Insert multiple channel records into the table at once.
 
         <data> is a list of dicts with a key for each <Channel> field.
-        If a channel record already exists the values will silently be 
-        overwritten.
+        If a channel record already exists it is silently skipped.
+
+        Returns a tuple (n_inserted, n_skipped)
         '''
-        with transaction.commit_on_success():
-            for row in data:
-                cls.objects.get_or_create(stock=row.pop('stock'), 
-                date=row.pop('date'), lookback=row.pop('lookback'),
-                defaults=row)
+        return bulk_insert(cls, data, ('stock', 'date', 'lookback'))
 
 
     @classmethod
@@ -144,6 +209,10 @@ class Channel(models.Model):
         '''
         Return the lowest date for <stock>
         '''
+        if cls.storage == cls.HISTORY:
+            qs = ChannelHistory.objects.filter(stock=stock).aggregate(
+                    Min('startdate'))
+            return qs['startdate__min']
         qs = Channel.objects.filter(stock=stock).aggregate(Min('date'))
         return qs['date__min']
 
@@ -153,10 +222,69 @@ class Channel(models.Model):
         '''
         Return the highest date for <stock>
         '''
+        if cls.storage == cls.HISTORY:
+            qs = ChannelHistory.objects.filter(stock=stock).aggregate(
+                    Max('enddate'))
+            return qs['enddate__max']
         qs = Channel.objects.filter(stock=stock).aggregate(Max('date'))
         return qs['date__max']
 
 
+    @classmethod
+    def stored_dates(cls, stock):
+        '''
+        Returns a set with the dates for which channel data of <stock> is
+        stored (for any lookback).
+        '''
+        if cls.storage == cls.HISTORY:
+            dates = set()
+            for history in ChannelHistory.objects.filter(stock=stock).defer(
+                    'data'):
+                dates.update(history.get_dates())
+            return dates
+        return set(Channel.objects.filter(stock=stock).values_list('date', 
+                flat=True))
+
+
+    @classmethod
+    def on_date(cls, stocks, date, lookback=None):
+        '''
+        Returns a list with the channels of <stocks> on <date>, for all 
+        lookbacks or only for <lookback>. Like the with_close manager, each
+        channel has the close price on <date> in <close>.
+        The channels are read from the Channel table or from the ChannelHistory
+        table, depending on <cls.storage>. Channels from the ChannelHistory 
+        table are Channel instances that are not saved.
+        '''
+        if cls.storage != cls.HISTORY:
+            channels = cls.with_close.filter(stock__in=stocks, date=date)
+            if lookback is not None:
+                channels = channels.filter(lookback=lookback)
+            return list(channels)
+        histories = ChannelHistory.objects.filter(stock__in=stocks, 
+                startdate__lte=date, enddate__gte=date).select_related('stock'
+                ).defer('data')
+        if lookback is not None:
+            histories = histories.filter(lookback=lookback)
+        Price = models.get_model('pricemanager', 'Price')
+        closes = dict(Price.objects.filter(stock__in=stocks, date=date
+                ).values_list('stock', 'close'))
+        ordinal = date.toordinal()
+        channels = []
+        for history in histories:
+            ordinals, values = history.get_arrays()
+            i_date = np.searchsorted(ordinals, ordinal)
+            if i_date == len(ordinals) or ordinals[i_date] != ordinal:
+                continue
+            angle, width, bottom = values[i_date].tolist()
+            channel = cls(stock=history.stock, date=date, 
+                    lookback=history.lookback, angle=angle, width=width, 
+                    bottom=Decimal('{:.2f}'.format(bottom)))
+            channel.close = closes.get(history.stock_id)
+            channels.append(channel)
+        return channels
+
+
     def stoploss(self, close=None):
         if close is None:
             close = self.stock.get_close(self.date)
@@ -193,36 +321,180 @@ class Channel(models.Model):
 
 
 
+class ChannelHistory(models.Model):
+    '''
+    Compact storage of channel data: the entire channel history of a stock for
+    one lookback is stored in one row, as an int32 array with the date 
+    ordinals and a float32 array with shape (n_dates, 3) with angle, width and
+    bottom (Channel.FIELDS). This is used instead of the Channel table if 
+    settings.CHANNEL_STORAGE is 'history'.
+    Django 1.5 has no binary field, so the packed arrays are stored base64
+    encoded in <data>.
+    Decoded arrays are kept per (stock id, lookback) in <_arrays> for the
+    lifetime of the process, so queries that only need the arrays can defer
+    <data>. The cached arrays are replaced when set_arrays writes new arrays
+    or when the row has a different number of dates or enddate (e.g. it was
+    updated by another process).
+    '''
+    _arrays = {}
+
+    stock = models.ForeignKey('pricemanager.Stock')
+    lookback = models.PositiveSmallIntegerField(
+            choices=Channel.LOOKBACK_CHOICES)
+    startdate = models.DateField()
+    enddate = models.DateField()
+    n_dates = models.PositiveIntegerField()
+    data = models.TextField()
+
+
+    @classmethod
+    def add(cls, stock, lookback, dates, channels):
+        '''
+        Add the (n_dates, 3) array <channels> on the sorted list <dates> to the
+        history of <stock> and <lookback>. Dates that are already stored are
+        skipped, they are not overwritten. New dates after the last stored date
+        (e.g. daily updates) are appended without sorting.
+        NOTE: the row holds one packed blob, so every update (also a daily
+        update of one date) re-encodes and rewrites the entire history of 
+        <stock> and <lookback>.
+
+        Returns a tuple (n_inserted, n_skipped)
+        '''
+        if not len(dates):
+            return 0, 0
+        ordinals = np.array([d.toordinal() for d in dates], dtype=np.int32)
+        channels = np.asarray(channels, dtype=np.float32)
+        try:
+            history = cls.objects.get(stock=stock, lookback=lookback)
+        except cls.DoesNotExist:
+            history = cls(stock=stock, lookback=lookback)
+            stored_ordinals, stored_channels = ordinals[:0], channels[:0]
+        else:
+            stored_ordinals, stored_channels = history.get_arrays()
+        is_new = ~np.in1d(ordinals, stored_ordinals)
+        n_new = int(is_new.sum())
+        if not n_new:
+            return 0, len(dates)
+        needs_sort = len(stored_ordinals) and ordinals[is_new][0] < \
+                stored_ordinals[-1]
+        ordinals = np.concatenate((stored_ordinals, ordinals[is_new]))
+        channels = np.concatenate((stored_channels, channels[is_new]))
+        if needs_sort: # new dates are not simply appended
+            order = np.argsort(ordinals, kind='mergesort')
+            ordinals = ordinals[order]
+            channels = channels[order]
+        history.set_arrays(ordinals, channels)
+        history.save()
+        return n_new, len(dates) - n_new
+
+
+    @classmethod
+    def export_table(cls, stocks=None):
+        '''
+        Copy the channel data of <stocks> (default: all stocks with channel 
+        data) from the Channel table to this table. Existing histories of these
+        stocks are replaced.
+        Returns the number of (stock, lookback) histories that were written.
+        '''
+        if stocks is None:
+            stock_ids = Channel.objects.values_list('stock', flat=True
+                    ).order_by('stock').distinct()
+        else:
+            stock_ids = [stock.id for stock in stocks]
+        n_histories = 0
+        for stock_id in stock_ids:
+            rows = Channel.objects.filter(stock=stock_id).order_by('lookback',
+                    'date').values_list('lookback', 'date', *Channel.FIELDS)
+            with transaction.commit_on_success():
+                cls.objects.filter(stock=stock_id).delete()
+                for lookback, group in groupby(rows, itemgetter(0)):
+                    group = list(group)
+                    history = cls(stock_id=stock_id, lookback=lookback)
+                    history.set_arrays([row[1].toordinal() for row in group],
+                            [(a, w, float(b)) for unused, unused, a, w, b in 
+                            group])
+                    history.save()
+                    n_histories += 1
+        return n_histories
+
+
+    def get_arrays(self):
+        '''
+        Returns a tuple (ordinals, channels) with the int32 array of date 
+        ordinals and the (n_dates, 3) float32 array with the channels.
+        The arrays are cached (see the class docstring) and read-only.
+        '''
+        key = (self.stock_id, self.lookback)
+        version = (self.n_dates, self.enddate)
+        cached = self._arrays.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        packed = base64.b64decode(self.data)
+        n_bytes = 4 * self.n_dates
+        ordinals = np.fromstring(packed[:n_bytes], dtype=np.int32)
+        channels = np.fromstring(packed[n_bytes:], dtype=np.float32).reshape(
+                self.n_dates, len(Channel.FIELDS))
+        ordinals.flags.writeable = False
+        channels.flags.writeable = False
+        self._arrays[key] = (version, (ordinals, channels))
+        return ordinals, channels
+
+
+    def get_dates(self):
+        '''
+        Returns a list with the dates of the history.
+        '''
+        return [datetime.date.fromordinal(o) for o in 
+                self.get_arrays()[0].tolist()]
+
+
+    def set_arrays(self, ordinals, channels):
+        '''
+        Store the (sorted) date <ordinals> and the (n_dates, 3) array 
+        <channels>.
+        '''
+        ordinals = np.asarray(ordinals, dtype=np.int32)
+        channels = np.asarray(channels, dtype=np.float32).reshape(-1, 
+                len(Channel.FIELDS))
+        self.n_dates = len(ordinals)
+        self.startdate = datetime.date.fromordinal(int(ordinals[0]))
+        self.enddate = datetime.date.fromordinal(int(ordinals[-1]))
+        self.data = base64.b64encode(ordinals.tostring() + 
+                channels.tostring())
+        self._arrays.pop((self.stock_id, self.lookback), None)
+
+    class Meta:
+        ordering = ['stock', 'lookback']
+        unique_together = (('stock', 'lookback'),)
+
+
+    def __unicode__(self):
+        return '{}, {}, {} - {}'.format(self.stock, self.lookback, 
+                self.startdate, self.enddate)
+
+
+
 class ChannelData(object):
     '''
     This class provides an interface to channel data from the database. It is 
     not used for calculating channels.
     If no channel data is available in the database, it is calculated 
-    automatically (but not stored in the database).
+    automatically (and only stored in the database if <save> is True).
     '''
 
-    def __init__(self, stock):
+    def __init__(self, stock, save=False):
         self._data = {}
         self.stock = stock
+        self.save = save
 
 
     @staticmethod
     def pool_market(pool, lookback):
-        
-        
-        dates = pool.index.price.close.dates
-        percentage = []
-        for date in dates:
-            stock_list = pool.get_cached_stocklist(date)
-            n_total = len(stock_list)
-    
-            if n_total > 0:
-                n_pos = sum(1 if s.price.channel.angle(lookback)[date] > 0 
-                        else 0 for s in stock_list)
-                percentage.append(n_pos / n_total)
-            else:
-                percentage.append(0)
-        return DatedList(percentage, dates)
+        '''
+        Returns a DatedList with the fraction of the members of <pool> with a
+        positive <lookback> channel angle, see Pool.market_breadth.
+        '''
+        return pool.market_breadth(lookback)
 
 
     def sumangle(self):
@@ -233,19 +505,12 @@ class ChannelData(object):
 #CONSIDER: add 15 as lowest channel (and delete 21/42?)
         '''
         if 'sumangle' not in self._data:
-#            for lookback in Channel.LOOKBACKS:
-            data = [(0*a*Channel.MONTH + b*Channel.SIXWEEKS + 
-                    0*c*Channel.TWOMONTHS
-                    + d*Channel.QUARTER + e*Channel.SIXMONTHS + f*Channel.YEAR)
-                    /100 for a,b,c,d,e,f in zip(
-                    self.angle(Channel.MONTH).as_list(), 
-                    self.angle(Channel.SIXWEEKS).as_list(), 
-                    self.angle(Channel.TWOMONTHS).as_list(), 
-                    self.angle(Channel.QUARTER).as_list(), 
-                    self.angle(Channel.SIXMONTHS).as_list(), 
-                    self.angle(Channel.YEAR).as_list())]
-            self._data['sumangle'] = DatedList(data, 
-                    self.angle(Channel.YEAR).dates)
+            weights = np.array([lookback / 100 for lookback in 
+                    Channel.LOOKBACKS])
+            weights[[Channel.LOOKBACKS.index(Channel.MONTH), 
+                    Channel.LOOKBACKS.index(Channel.TWOMONTHS)]] = 0
+            self._data['sumangle'] = self._series(np.dot(weights, 
+                    self._matrix('angle')), self.angle(Channel.YEAR))
         return self._data['sumangle']
 
 
@@ -255,23 +520,13 @@ class ChannelData(object):
         Widths are balanced by multiplying them with 10/sqrt(lookback)
 #NOTE: 21 and 42 are set to 0 for now
         '''
-        srY = Channel.YEAR ** -0.5
-        srSM = Channel.SIXMONTHS ** -0.5
-        srQ = Channel.QUARTER ** -0.5
-        srTM = Channel.TWOMONTHS ** -0.5
-        srSW = Channel.SIXWEEKS ** -0.5
-        srM = Channel.MONTH ** -0.5
         if 'sumwidth' not in self._data:
-            data = [(0*a*srM + b*srSW + 0*c*srTM + d*srQ + e*srSM + f*srY)*10
-                    for a,b,c,d,e,f in zip(
-                    self.width(Channel.MONTH).as_list(), 
-                    self.width(Channel.SIXWEEKS).as_list(), 
-                    self.width(Channel.TWOMONTHS).as_list(), 
-                    self.width(Channel.QUARTER).as_list(), 
-                    self.width(Channel.SIXMONTHS).as_list(), 
-                    self.width(Channel.YEAR).as_list())]
-            self._data['sumwidth'] = DatedList(data, 
-                    self.angle(Channel.YEAR).dates)
+            weights = np.array([10 * lookback ** -0.5 for lookback in 
+                    Channel.LOOKBACKS])
+            weights[[Channel.LOOKBACKS.index(Channel.MONTH), 
+                    Channel.LOOKBACKS.index(Channel.TWOMONTHS)]] = 0
+            self._data['sumwidth'] = self._series(np.dot(weights, 
+                    self._matrix('width')), self.angle(Channel.YEAR))
         return self._data['sumwidth']
 
 
@@ -292,10 +547,9 @@ class ChannelData(object):
         if lookback not in self._data:
             self._load_data(lookback)
         if 'angle_n' not in self._data[lookback]:
-            factor = lookback / Channel.YEAR
-            data = [a * factor for a in self.angle(lookback).as_list()]
-            self._data[lookback]['angle_n'] = DatedList(data, 
-                    self.angle(lookback).dates)
+            angle = self.angle(lookback)
+            self._data[lookback]['angle_n'] = self._series(angle.values * 
+                    _normalisation('angle', lookback), angle)
         return self._data[lookback]['angle_n']
 
 
@@ -304,15 +558,8 @@ class ChannelData(object):
         Return a DatedList with the highest normalised channel angle.
         '''
         if 'angle_max' not in self._data:
-            data = [max(angles) for angles in zip(
-                    self.angle_n(Channel.MONTH).as_list(), 
-                    self.angle_n(Channel.SIXWEEKS).as_list(), 
-                    self.angle_n(Channel.TWOMONTHS).as_list(), 
-                    self.angle_n(Channel.QUARTER).as_list(), 
-                    self.angle_n(Channel.SIXMONTHS).as_list(), 
-                    self.angle_n(Channel.YEAR).as_list())]
-            self._data['angle_max'] = DatedList(data, 
-                    self.angle(Channel.MONTH).dates)
+            self._data['angle_max'] = self._series(self._normalised(
+                    'angle').max(axis=0), self.angle(Channel.MONTH))
         return self._data['angle_max']
 
 
@@ -321,15 +568,8 @@ class ChannelData(object):
         Return a DatedList with the lowest normalised channel angle.
         '''
         if 'angle_min' not in self._data:
-            data = [min(angles) for angles in zip(
-                    self.angle_n(Channel.MONTH).as_list(), 
-                    self.angle_n(Channel.SIXWEEKS).as_list(), 
-                    self.angle_n(Channel.TWOMONTHS).as_list(), 
-                    self.angle_n(Channel.QUARTER).as_list(), 
-                    self.angle_n(Channel.SIXMONTHS).as_list(), 
-                    self.angle_n(Channel.YEAR).as_list())]
-            self._data['angle_min'] = DatedList(data, 
-                    self.angle(Channel.MONTH).dates)
+            self._data['angle_min'] = self._series(self._normalised(
+                    'angle').min(axis=0), self.angle(Channel.MONTH))
         return self._data['angle_min']
 
 
@@ -350,10 +590,9 @@ class ChannelData(object):
         if lookback not in self._data:
             self._load_data(lookback)
         if 'width_n' not in self._data[lookback]:
-            factor = (Channel.YEAR / lookback) ** 0.5
-            data = [w * factor for w in self.width(lookback).as_list()]
-            self._data[lookback]['width_n'] = DatedList(data, 
-                    self.width(lookback).dates)
+            width = self.width(lookback)
+            self._data[lookback]['width_n'] = self._series(width.values * 
+                    _normalisation('width', lookback), width)
         return self._data[lookback]['width_n']
 
 
@@ -362,32 +601,18 @@ class ChannelData(object):
         Return a DatedList with the lowest normalised channel width.
         '''
         if 'width_min' not in self._data:
-            data = [min(widths) for widths in zip(
-                    self.width_n(Channel.MONTH).as_list(), 
-                    self.width_n(Channel.SIXWEEKS).as_list(), 
-                    self.width_n(Channel.TWOMONTHS).as_list(), 
-                    self.width_n(Channel.QUARTER).as_list(), 
-                    self.width_n(Channel.SIXMONTHS).as_list(), 
-                    self.width_n(Channel.YEAR).as_list())]
-            self._data['width_min'] = DatedList(data, 
-                    self.width(Channel.MONTH).dates)
+            self._data['width_min'] = self._series(self._normalised(
+                    'width').min(axis=0), self.width(Channel.MONTH))
         return self._data['width_min']
 
 
     def width_max(self):
         '''
-        Return a DatedList with the lowest normalised channel width.
+        Return a DatedList with the highest normalised channel width.
         '''
         if 'width_max' not in self._data:
-            data = [max(widths) for widths in zip(
-                    self.width_n(Channel.MONTH).as_list(), 
-                    self.width_n(Channel.SIXWEEKS).as_list(), 
-                    self.width_n(Channel.TWOMONTHS).as_list(), 
-                    self.width_n(Channel.QUARTER).as_list(), 
-                    self.width_n(Channel.SIXMONTHS).as_list(), 
-                    self.width_n(Channel.YEAR).as_list())]
-            self._data['width_max'] = DatedList(data, 
-                    self.width(Channel.MONTH).dates)
+            self._data['width_max'] = self._series(self._normalised(
+                    'width').max(axis=0), self.width(Channel.MONTH))
         return self._data['width_max']
 
 
@@ -407,10 +632,9 @@ class ChannelData(object):
         if lookback not in self._data:
             self._load_data(lookback)
         if 'top' not in self._data[lookback]:
-            data = [o * (1 + 0.01*w) for o, w in zip(self.bottom(
-                    lookback).as_list(), self.width(lookback).as_list())]
-            self._data[lookback]['top'] = DatedList(data, 
-                    self.bottom(lookback).dates)
+            bottom = self.bottom(lookback)
+            self._data[lookback]['top'] = self._series(bottom.values * (1 + 
+                    0.01 * self.width(lookback).values), bottom)
         return self._data[lookback]['top']
 
 
@@ -421,10 +645,9 @@ class ChannelData(object):
         if lookback not in self._data:
             self._load_data(lookback)
         if 'quality' not in self._data[lookback]:
-            data = [div(a, w) for a, w in zip(self.angle(lookback).as_list(), 
-                    self.width(lookback).as_list())]
-            self._data[lookback]['quality'] = DatedList(data, 
-                    self.angle(lookback).dates)
+            angle = self.angle(lookback)
+            self._data[lookback]['quality'] = self._series(_div(angle.values,
+                    self.width(lookback).values), angle)
         return self._data[lookback]['quality']
 
 
@@ -436,10 +659,9 @@ class ChannelData(object):
         if lookback not in self._data:
             self._load_data(lookback)
         if 'quality_n' not in self._data[lookback]:
-            data = [div(a, w) for a, w in zip(self.angle_n(lookback).as_list(), 
-                    self.width_n(lookback).as_list())]
-            self._data[lookback]['quality_n'] = DatedList(data, 
-                    self.angle(lookback).dates)
+            self._data[lookback]['quality_n'] = self._series(_div(
+                    self.angle_n(lookback).values, 
+                    self.width_n(lookback).values), self.angle(lookback))
         return self._data[lookback]['quality_n']
 
 
@@ -532,45 +754,170 @@ THIS IS OBSOLETE, ONLY USE stoptop or stopbottom
                 print self.stock.missing_channels()
                 raise ValueError('prices are not same length as channels: {} != {}'\
                         .format(len(close_prices), len(self.angle(lookback))))
-            rc = [max(0, min(1, (c - o) / (t - o))) for c, o, t in zip(close_prices,
-                    self.bottom(lookback).as_list(), self.top(lookback).as_list())]
-            self._data[lookback]['rc'] = DatedList(rc, 
-                    self.bottom(lookback).dates)
+            bottom = self.bottom(lookback)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rc = np.clip((close_prices.values - bottom.values) / (
+                        self.top(lookback).values - bottom.values), 0, 1)
+            self._data[lookback]['rc'] = self._series(rc, bottom)
         return self._data[lookback]['rc']
 
-#        dates = self.angle(lookback).dates
-#        close_prices = self.stock.price.close[dates[0]:dates[-1]]
-#        if len(close_prices) != len(self.angle(lookback)):
-#            print self.stock.missing_channels()
-#            raise ValueError('prices are not same length as channels: {} != {}'\
-#                    .format(len(close_prices), len(self.angle(lookback))))
-#        rc = [max(0, min(1, (c - o) / (t - o))) for c, o, t in zip(close_prices,
-#                self.bottom(lookback).as_list(), self.top(lookback).as_list())]
-#        return DatedList(rc, dates)
+
+    def _series(self, values, like):
+        '''
+        Returns a DatedList with the array <values> on the dates of the 
+        DatedList <like> (the calendar is shared, not copied).
+        '''
+        return DatedList(values, like.calendar, like.start)
+
+
+    def _matrix(self, field):
+        '''
+        Returns a (n_lookbacks, n_dates) array with channel <field> for all
+        Channel.LOOKBACKS (in that order), so that series that combine all 
+        lookbacks are single numpy operations. All lookbacks are loaded.
+        '''
+        key = ('matrix', field)
+        if key not in self._data:
+            self.load()
+            self._data[key] = np.vstack([self._data[lookback][field].values 
+                    for lookback in Channel.LOOKBACKS])
+        return self._data[key]
+
+
+    def _normalised(self, field):
+        '''
+        Returns the matrix of <field> (see _matrix), with each row normalised
+        like angle_n or width_n.
+        '''
+        key = ('normalised', field)
+        if key not in self._data:
+            factors = np.array([_normalisation(field, lookback) for lookback in
+                    Channel.LOOKBACKS])
+            self._data[key] = self._matrix(field) * factors[:, np.newaxis]
+        return self._data[key]
 
 
     def _load_data(self, lookback):
         '''
-        Load channel data from the database and store it in DatedList objects.
+        Load the channel data of <lookback>, see load.
+        '''
+        self.load([lookback])
+
+
+    def load(self, lookbacks=Channel.LOOKBACKS):
+        '''
+        Load the channel data of all <lookbacks> that are not loaded yet from
+        the database and store it in DatedList objects (with the dates of the
+        price calendar in the date_range of the stock).
+        Channels that are not in the database are calculated (all lookbacks in
+        one pass over the prices) and saved if <self.save> is True.
         Note that StockPrice objects are not used, because the indicator 
         functionality is not necessary (for now).
         '''
-        startdate, enddate = self.stock.date_range
-        self._data[lookback] = {}
-        qs = Channel.objects.filter(stock=self.stock, date__gte=startdate,
-                lookback=lookback, date__lte=enddate).order_by('date')
-        qs = None
-        if qs:
-            # Retrieve the channel information from the database
-            dates = [s.date for s in qs]
-            for field in ('angle', 'width', 'bottom'):
-                data = [float(getattr(s, field)) for s in qs]
-                self._data[lookback][field] = DatedList(data, dates)
-        else:
+        lookbacks = [lookback for lookback in lookbacks if lookback not in 
+                self._data]
+        if not lookbacks:
+            return
+        dates = self.stock.price.close.get_dates(*self.stock.date_range)
+        channels = np.empty((len(lookbacks), len(dates), len(Channel.FIELDS)))
+        found = np.zeros((len(lookbacks), len(dates)), dtype=bool)
+        if dates and Channel.storage == Channel.HISTORY:
+            self._fetch_history(lookbacks, dates, channels, found)
+        elif dates:
+            i_lookbacks = dict((lb, i) for i, lb in enumerate(lookbacks))
+            i_dates = dict((d, i) for i, d in enumerate(dates))
+            rows = Channel.objects.filter(stock=self.stock, 
+                    lookback__in=lookbacks, date__gte=dates[0], 
+                    date__lte=dates[-1]).values_list('lookback', 'date', 
+                    *Channel.FIELDS)
+            for lookback, date, angle, width, bottom in rows:
+                i_date = i_dates.get(date)
+                if i_date is not None:
+                    i_lookback = i_lookbacks[lookback]
+                    channels[i_lookback, i_date] = (angle, width, 
+                            float(bottom))
+                    found[i_lookback, i_date] = True
+        missing = ~found.all(axis=0)
+        if missing.any():
             # Channel information does not exist in the database, calculate it
-            data = calc_channel(self.stock, lookback)
-            for field in ('angle', 'width', 'bottom'):
-                self._data[lookback][field] = data[field]
+            missing_dates = [dates[i] for i in np.flatnonzero(missing)]
+            unused, calculated = calc_channels_all_lookbacks(self.stock, 
+                    lookbacks, missing_dates)
+            not_found = ~found[:, missing]
+            channels_missing = channels[:, missing]
+            channels_missing[not_found] = calculated[not_found]
+            channels[:, missing] = channels_missing
+            if self.save:
+                self._save(lookbacks, missing_dates, calculated)
+        self._set_data(lookbacks, dates, channels)
+
+
+    def _fetch_history(self, lookbacks, dates, channels, found):
+        '''
+        Copy the channels of <lookbacks> on <dates> from the ChannelHistory 
+        table into the arrays <channels> and <found> (see load).
+        '''
+        ordinals = np.array([d.toordinal() for d in dates], dtype=np.int32)
+        i_lookbacks = dict((lb, i) for i, lb in enumerate(lookbacks))
+        for history in ChannelHistory.objects.filter(stock=self.stock, 
+                lookback__in=lookbacks).defer('data'):
+            i_lookback = i_lookbacks[history.lookback]
+            stored_ordinals, stored_channels = history.get_arrays()
+            if not len(stored_ordinals):
+                continue
+            indices = np.minimum(np.searchsorted(stored_ordinals, ordinals), 
+                    len(stored_ordinals) - 1)
+            is_stored = stored_ordinals[indices] == ordinals
+            channels[i_lookback, is_stored] = stored_channels[indices[
+                    is_stored]]
+            found[i_lookback] = is_stored
+
+
+    def _save(self, lookbacks, dates, channels):
+        '''
+        Save calculated channels to the database, like Channel.calculate only
+        dates with a full <lookback> of prices before them are saved.
+        '''
+        close = self.stock.price.close
+        i_save = [i for i, lookback in enumerate(lookbacks) if len(close) > 
+                lookback]
+        Channel.save_array(self.stock, [lookbacks[i] for i in i_save], dates,
+                channels[i_save], [close.dates[lookbacks[i]] for i in i_save])
+
+
+    def _set_data(self, lookbacks, dates, channels):
+        '''
+        Store the result of calc_channels_all_lookbacks in DatedList objects,
+        which are views onto the <channels> array and share one calendar. If
+        all lookbacks are loaded, the array is also used for _matrix.
+        '''
+        calendar = TradingCalendar(list(dates))
+        for lookback, data in zip(lookbacks, channels):
+            self._data[lookback] = dict((field, DatedList(data[:, i], calendar))
+                    for i, field in enumerate(Channel.FIELDS))
+        if tuple(lookbacks) == Channel.LOOKBACKS:
+            for i, field in enumerate(Channel.FIELDS):
+                self._data[('matrix', field)] = channels[:, :, i]
+
+
+def _normalisation(field, lookback):
+    '''
+    Returns the factor that normalises the angle or width (<field>) of a 
+    <lookback> channel to a one year channel.
+    '''
+    if field == 'angle':
+        return lookback / Channel.YEAR
+    return (Channel.YEAR / lookback) ** 0.5
+
+
+def _div(numerators, denominators):
+    '''
+    Element wise pyutillib div for arrays: 0 / 0 is 0.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerators / denominators
+    result[(numerators == 0) & (denominators == 0)] = 0
+    return result
 
 
 # the following functions are only used for calculating channels
@@ -583,19 +930,41 @@ def calc_channel(stock, lookback):
     and bottom for <lookback> period. The parameters are calculated from the
     available price data for this stock as set by the date_range.
     '''
-    angles = []
-    widths = []
-    bottoms = []
-    dates = stock.price.close.get_dates(*stock.date_range)
-    for date in dates:
-        width, angle, bottom = channel(stock.price.low[date:-lookback], 
-                stock.price.high[date:-lookback])
-        angles.append(angle)
-        widths.append(width)
-        bottoms.append(bottom)
-    return {'angle': DatedList(angles, dates), 
-            'width': DatedList(widths, dates), 
-            'bottom': DatedList(bottoms, dates)}
+    dates, channels = calc_channels_all_lookbacks(stock, [lookback])
+    return dict((field, DatedList(channels[0, :, i].tolist(), dates)) for 
+            i, field in enumerate(Channel.FIELDS))
+
+
+def calc_channels_all_lookbacks(stock, lookbacks=Channel.LOOKBACKS, 
+        dates=None):
+    '''
+    Returns a tuple (dates, channels) with the channels of all <lookbacks> for
+    the dates in the date_range of <stock>, or for the (sorted) list of price
+    dates <dates> if it is specified. <channels> is a float array with
+    shape (len(lookbacks), len(dates), 3), the last axis is Channel.FIELDS
+    (angle, width, bottom).
+    The logarithms of the prices are calculated once and shared by the 
+    SlidingChannels of all lookbacks, which are advanced together date by date.
+    '''
+    if dates is None:
+        dates = stock.price.close.get_dates(*stock.date_range)
+    channels = np.empty((len(lookbacks), len(dates), len(Channel.FIELDS)))
+    if not dates or not lookbacks:
+        return dates, channels
+    # only the prices from <lookback> days before the first date are needed
+    low = stock.price.low
+    i_from = max(low.index(dates[0]) - max(lookbacks) + 1, 0)
+    i_to = low.index(dates[-1]) + 1
+    sliding = SlidingChannel(low.values[i_from:i_to].tolist(),
+            stock.price.high.values[i_from:i_to].tolist(), lookbacks[0])
+    slidings = [sliding] + [sliding.with_lookback(lookback) for lookback in
+            lookbacks[1:]]
+    for i_date, date in enumerate(dates):
+        i = low.index(date) - i_from
+        for i_lookback, sliding in enumerate(slidings):
+            width, angle, bottom = sliding.channel(i)
+            channels[i_lookback, i_date] = (angle, width, bottom)
+    return dates, channels
 
 
 def get_width(lows, highs, index_lo, index_hi, alpha):
@@ -741,16 +1110,142 @@ def get_channel(lows, highs, low_angle, high_angle, current_angle):
     return get_channel(lows, highs, low_angle, high_angle, angle)
 
 
-def channel(lows, highs):
+def lower_hull(values):
+    '''
+    Returns a list with the indices of the points of the lower convex hull of
+    the points (i, values[i]). Because the x-values are sorted, the hull is
+    found in O(n) (monotone chain).
+    '''
+    hull = []
+    for i, val in enumerate(values):
+        while len(hull) > 1 and (hull[-1] - hull[-2]) * (val - 
+                values[hull[-2]]) - (i - hull[-2]) * (values[hull[-1]] - 
+                values[hull[-2]]) <= 0:
+            hull.pop()
+        hull.append(i)
+    return hull
+
+
+def upper_hull(values):
+    '''
+    Returns a list with the indices of the points of the upper convex hull of
+    the points (i, values[i]), see lower_hull.
+    '''
+    return lower_hull([-val for val in values])
+
+
+def get_extremes(values, hull, angle, i_hull, find_min, start=0):
+    '''
+    Returns the positions in <hull> of the first and the last point with the
+    minimum (or maximum if <find_min> is False) value of the rotated points,
+    i.e. the points of rotate_list(values, angle) that get_minlist (or 
+    get_maxlist) would return. Rotated values are convex along the hull, so the
+    search starts at position <i_hull> and walks towards the extreme.
+    The x-coordinate of point i is i - <start>.
+    '''
+    sign = 1 if find_min else -1
+    def rotated(i):
+        return sign * (values[hull[i]] + (0 - (hull[i] - start)) * angle)
+    while i_hull > 0 and rotated(i_hull - 1) < rotated(i_hull):
+        i_hull -= 1
+    while i_hull < len(hull) - 1 and rotated(i_hull + 1) < rotated(i_hull):
+        i_hull += 1
+    extreme = rotated(i_hull)
+    i_first = i_last = i_hull
+    while i_first > 0 and abs(rotated(i_first - 1) - extreme) < 1e-6:
+        i_first -= 1
+    while i_last < len(hull) - 1 and abs(rotated(i_last + 1) - extreme) < 1e-6:
+        i_last += 1
+    return i_first, i_last
+
+
+def get_hull_channel(lows, highs, lower=None, upper=None, start=0):
+    '''
+    Returns the raw channel parameters: angle, width and bottom, see 
+    get_channel.
+    This follows the same rotations as get_channel, but only the points on the
+    lower hull of <lows> and the upper hull of <highs> can be a minimum or
+    maximum, so the next angle is the slope of the next edge of a hull. 
+    Building the hulls is O(n) and each rotation O(1) (amortised).
+    If the hulls <lower> and <upper> are given (see SlidingHull), the channel
+    is calculated for the points from <start> up to the last point of the 
+    hulls.
+    '''
+    if lower is None:
+        lower = lower_hull(lows)
+        upper = upper_hull(highs)
+        start = 0
+    low_angle = high_angle = current_angle = 0
+    i_low = i_high = 0
+    # every two rotations move a pivot to the next point on its hull
+    for unused in range(2 * (len(lower) + len(upper)) + 2):
+        i_low, i_low_last = get_extremes(lows, lower, current_angle, i_low, 
+                True, start)
+        i_high, i_high_last = get_extremes(highs, upper, current_angle, i_high,
+                False, start)
+        if upper[i_high] > lower[i_low_last]:
+            # rotate up
+            i_low = i_low_last
+            refresh_low = low_angle <= high_angle
+            refresh_high = low_angle >= high_angle
+            angle = low_angle if refresh_low else high_angle
+            if refresh_low:
+                low_angle = get_slope(lows, lower[i_low], lower[i_low + 1])
+            if refresh_high:
+                high_angle = get_slope(highs, upper[i_high - 1], upper[i_high])
+        elif upper[i_high_last] < lower[i_low]:
+            # rotate down
+            i_high = i_high_last
+            refresh_low = low_angle >= high_angle
+            refresh_high = low_angle <= high_angle
+            angle = low_angle if refresh_low else high_angle
+            if refresh_low:
+                low_angle = get_slope(lows, lower[i_low - 1], lower[i_low])
+            if refresh_high:
+                high_angle = get_slope(highs, upper[i_high], upper[i_high + 1])
+        else:
+            # angle found
+            index_low = lower[i_low]
+            index_high = upper[i_high]
+            width = get_width(lows, highs, index_low, index_high, 
+                    current_angle)
+            bottom = lows[index_low] + current_angle * (lower[-1] + 1 - start
+                    - (index_low - start + 1))
+            return (current_angle, width, bottom)
+        current_angle = angle
+    raise ValueError('no channel found')
+
+
+def get_slope(values, i_left, i_right):
+    '''
+    Returns the slope of the line from point <i_left> to point <i_right>,
+    calculated the same way as get_alpha_left/get_alpha_right do.
+    '''
+    return (values[i_right] - values[i_left]) / (i_right - i_left)
+
+
+def channel(lows, highs, recursive=False):
     '''
     Returns the smallest width and corresponding angle of the price data in 
     <lows> and <highs> 
+    The channel is found on the convex hulls of the prices (get_hull_channel),
+    set <recursive> to use the original rotation search (get_channel) instead.
     '''
-    year = 252 # Average number of trading days per year
-
     lows = [math.log10(l) for l in lows]
     highs = [math.log10(h) for h in highs]
-    a, w, b = get_channel(lows, highs, 0, 0, 0)
+    if recursive:
+        return channel_params(*get_channel(lows, highs, 0, 0, 0))
+    else:
+        return channel_params(*get_hull_channel(lows, highs))
+
+
+def channel_params(a, w, b):
+    '''
+    Returns the width (in %), angle (in % per year) and bottom of the raw 
+    (logarithmic) channel parameters <a>, <w> and <b>.
+    '''
+    year = 252 # Average number of trading days per year
+
     angle = 10 ** a
     width = 10 ** w
     bottom = 10 ** b
@@ -759,3 +1254,95 @@ def channel(lows, highs):
     width = 100 * (width - 1)
     angle = 100 * (angle ** year - 1)
     return width, angle, bottom
+
+
+
+class SlidingHull(object):
+    '''
+    The lower convex hull of the points (i, values[i]) in a window from 
+    <self.start> to <self.stop> (exclusive) that slides over <values>.
+    Points are added at the right as in lower_hull. Points that leave the 
+    window at the left are only removed when they are on the hull; then the
+    hull is rebuilt from the new start up to the first hull point that remains
+    (the rest of the hull does not change).
+    '''
+
+    def __init__(self, values):
+        self.values = values
+        self.hull = []
+        self.start = self.stop = 0
+
+
+    def _push(self, i):
+        values = self.values
+        hull = self.hull
+        val = values[i]
+        while len(hull) > 1 and (hull[-1] - hull[-2]) * (val - 
+                values[hull[-2]]) - (i - hull[-2]) * (values[hull[-1]] - 
+                values[hull[-2]]) <= 0:
+            hull.pop()
+        hull.append(i)
+
+
+    def slide(self, start, stop):
+        '''
+        Move the window to the points from <start> to <stop> (exclusive). The
+        window can only move to the right.
+        '''
+        if start < self.start or stop < self.stop or start >= stop:
+            raise ValueError('the window can only move to the right')
+        for i in range(self.stop, stop):
+            self._push(i)
+        self.stop = stop
+        if start > self.start:
+            self.start = start
+            if self.hull[0] < start:
+                old_hull = self.hull
+                self.hull = []
+                i_keep = bisect_left(old_hull, start)
+                for i in range(start, old_hull[i_keep]):
+                    self._push(i)
+                for i in old_hull[i_keep:]:
+                    self._push(i)
+
+
+
+class SlidingChannel(object):
+    '''
+    Calculates the channels of a <lookback> days window that slides over the
+    prices <lows> and <highs>, so that the channels for consecutive dates are
+    calculated without recalculating the logarithms and hulls of all prices in
+    the window. The results are the same as those of channel().
+    '''
+
+    def __init__(self, lows, highs, lookback):
+        self.lows = [math.log10(l) for l in lows]
+        self.highs = [math.log10(h) for h in highs]
+        self.lookback = lookback
+        self.lower = SlidingHull(self.lows)
+        self.upper = SlidingHull([-h for h in self.highs])
+
+
+    def with_lookback(self, lookback):
+        '''
+        Returns a SlidingChannel for <lookback> over the same prices, that 
+        shares the logarithms of the prices with this one.
+        '''
+        sliding = copy(self)
+        sliding.lookback = lookback
+        sliding.lower = SlidingHull(self.lows)
+        sliding.upper = SlidingHull(self.upper.values)
+        return sliding
+
+
+    def channel(self, i):
+        '''
+        Returns the width, angle and bottom of the channel of the <lookback>
+        prices up to (and including) index <i>. <i> can not be lower than in 
+        the previous call.
+        '''
+        start = max(i - self.lookback + 1, 0)
+        self.lower.slide(start, i + 1)
+        self.upper.slide(start, i + 1)
+        return channel_params(*get_hull_channel(self.lows, self.highs, 
+                self.lower.hull, self.upper.hull, start))
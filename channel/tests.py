@@ -4,9 +4,20 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+from __future__ import division
+from __future__ import absolute_import
+
+from datetime import date
+from random import Random
 
 from django.test import TestCase
 
+from pricemanager.models import Stock
+
+from channel.models import Channel, ChannelData, ChannelHistory, channel,\
+        lower_hull, upper_hull, SlidingHull, SlidingChannel, calc_channels_all_lookbacks
+from metasystem.parameters.params_rank import rank_cha
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +25,221 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class ChannelTests(TestCase):
+
+    def test_hulls(self):
+        values = [3., 1., 2., 0., 2., 4., 3.]
+        self.assertEqual(lower_hull(values), [0, 1, 3, 6])
+        self.assertEqual(upper_hull(values), [0, 5, 6])
+        self.assertEqual(lower_hull([1., 1., 1.]), [0, 2])
+        self.assertEqual(lower_hull([1.]), [0])
+
+    def test_channel(self):
+        '''
+        The hull algorithm must give exactly the same results as the recursive
+        rotation search.
+        '''
+        cases = [([1.], [1.]), ([5.] * 30, [6.] * 30),
+                ([1. + i for i in range(40)], [2. + i for i in range(40)]),
+                ([50. - i for i in range(40)], [52. - i for i in range(40)]),
+                ([10, 10, 10, 11, 12, 10, 10, 9, 9, 9], 
+                    [11, 12, 12, 13, 12, 11, 11, 10, 10, 10])]
+        rnd = Random(1)
+        for unused in range(100):
+            price = rnd.choice((0.5, 5., 50., 500.))
+            lows, highs = [], []
+            for unused in range(rnd.choice(Channel.LOOKBACKS)):
+                price *= 1 + rnd.gauss(rnd.choice((-0.002, 0, 0.002)), 0.02)
+                low = max(round(price * (1 - abs(rnd.gauss(0, 0.01))), 2), 0.01)
+                lows.append(low)
+                highs.append(max(round(price * (1 + abs(rnd.gauss(0, 0.01))), 
+                        2), low))
+            cases.append((lows, highs))
+        for lows, highs in cases:
+            self.assertEqual(channel(lows, highs), 
+                    channel(lows, highs, recursive=True))
+
+    def test_sliding(self):
+        rnd = Random(2)
+        price = 50.
+        lows, highs = [], []
+        for unused in range(300):
+            price *= 1 + rnd.gauss(0, 0.02)
+            lows.append(round(price * (1 - abs(rnd.gauss(0, 0.01))), 2))
+            highs.append(round(price * (1 + abs(rnd.gauss(0, 0.01))), 2))
+        hull = SlidingHull(lows)
+        for i in range(300):
+            hull.slide(max(i - 20, 0), i + 1)
+            self.assertEqual(hull.hull, [max(i - 20, 0) + j for j in 
+                    lower_hull(lows[max(i - 20, 0):i + 1])])
+        self.assertRaises(ValueError, hull.slide, 0, 300)
+        for lookback in (Channel.MONTH, Channel.QUARTER):
+            sliding = SlidingChannel(lows, highs, lookback)
+            for i in range(0, 300, 3):
+                i_from = max(i - lookback + 1, 0)
+                self.assertEqual(sliding.channel(i), channel(lows[i_from:i + 1],
+                        highs[i_from:i + 1], recursive=True))
+
+
+class ChannelFixtureTests(TestCase):
+    fixtures = ['PriceData.json']
+
+    def test_channel(self):
+        for name in ('AAPL', 'INTC'):
+            stock = Stock.objects.get(name=name)
+            stock.price_date_range = (date(2011,1,1), date(2012,12,31))
+            low = stock.price.low
+            high = stock.price.high
+            for lookback in Channel.LOOKBACKS:
+                for d in low.dates[lookback::5]:
+                    self.assertEqual(channel(low[d:-lookback], 
+                            high[d:-lookback]), channel(low[d:-lookback], 
+                            high[d:-lookback], recursive=True))
+
+    def test_all_lookbacks(self):
+        stock = Stock.objects.get(name='AAPL')
+        stock.date_range = (date(2012,1,1), date(2012,6,30))
+        low = stock.price.low
+        high = stock.price.high
+        dates, channels = calc_channels_all_lookbacks(stock)
+        self.assertEqual(channels.shape, (len(Channel.LOOKBACKS), len(dates),
+                3))
+        self.assertEqual(dates, low.get_dates(date(2012,1,1), 
+                date(2012,6,30)))
+        for i_lookback, lookback in enumerate(Channel.LOOKBACKS):
+            for i_date, d in enumerate(dates):
+                width, angle, bottom = channel(low[d:-lookback], 
+                        high[d:-lookback])
+                self.assertEqual(channels[i_lookback, i_date].tolist(), 
+                        [angle, width, bottom])
+        data = ChannelData(stock)
+        data.load()
+        self.assertEqual(data.angle(Channel.QUARTER).as_list(), 
+                channels[2, :, 0].tolist())
+        self.assertEqual(data.bottom(Channel.MONTH).as_list(), 
+                channels[5, :, 2].tolist())
+
+    def test_load(self):
+        stock = Stock.objects.get(name='AAPL')
+        stock.date_range = (date(2012,5,1), date(2012,6,30))
+        Channel.calculate(stock, date(2012,5,1), date(2012,6,30))
+        dates, channels = calc_channels_all_lookbacks(stock)
+        n_channels = Channel.objects.filter(stock=stock).count()
+        self.assertEqual(n_channels, len(Channel.LOOKBACKS) * len(dates))
+        Channel.objects.filter(stock=stock, date=dates[3], 
+                lookback=Channel.MONTH).delete()
+        Channel.objects.filter(stock=stock, date__gt=dates[-5]).delete()
+        data = ChannelData(stock, save=True)
+        data.load()
+        for i_lookback, lookback in enumerate(Channel.LOOKBACKS):
+            self.assertEqual(data.angle(lookback).as_list(), 
+                    channels[i_lookback, :, 0].tolist())
+            self.assertEqual(data.width(lookback).dates, dates)
+            for bottom, channel_bottom in zip(data.bottom(lookback), 
+                    channels[i_lookback, :, 2]):
+                self.assertAlmostEqual(bottom, channel_bottom, 2)
+        self.assertEqual(Channel.objects.filter(stock=stock).count(), 
+                n_channels)
+
+    def test_history(self):
+        stock = Stock.objects.get(name='AAPL')
+        stock.date_range = (date(2012,5,1), date(2012,6,30))
+        Channel.calculate(stock, date(2012,5,1), date(2012,6,30))
+        dates, channels = calc_channels_all_lookbacks(stock)
+        self.assertEqual(ChannelHistory.export_table([stock]), 
+                len(Channel.LOOKBACKS))
+        history = ChannelHistory.objects.get(stock=stock, 
+                lookback=Channel.MONTH)
+        self.assertEqual(history.get_dates(), list(dates))
+        self.assertEqual(history.get_arrays()[1].tolist(), 
+                channels[5].astype('float32').tolist())
+        history.delete()
+        self.assertEqual(ChannelHistory.add(stock, Channel.MONTH, dates[5:],
+                channels[5, 5:]), (len(dates) - 5, 0))
+        self.assertEqual(ChannelHistory.add(stock, Channel.MONTH, dates,
+                channels[5]), (5, len(dates) - 5))
+        self.assertEqual(ChannelHistory.add(stock, Channel.MONTH, dates,
+                channels[5]), (0, len(dates)))
+        history = ChannelHistory.objects.get(stock=stock, 
+                lookback=Channel.MONTH)
+        self.assertEqual(history.get_dates(), list(dates))
+        self.assertEqual(history.get_arrays()[1].tolist(), 
+                channels[5].astype('float32').tolist())
+        # the decoded arrays are cached, also for rows without <data>
+        arrays = history.get_arrays()
+        self.assertFalse(arrays[1].flags.writeable)
+        self.assertIs(ChannelHistory.objects.defer('data').get(stock=stock,
+                lookback=Channel.MONTH).get_arrays()[1], arrays[1])
+        storage = Channel.storage
+        Channel.storage = Channel.HISTORY
+        try:
+            data = ChannelData(stock)
+            data.load()
+            self.assertEqual(data.angle(Channel.MONTH).as_list(), 
+                    channels[5, :, 0].astype('float32').tolist())
+            self.assertEqual(Channel.get_enddate(stock), dates[-1])
+        finally:
+            Channel.storage = storage
+
+    def test_history_rank(self):
+        stocks = list(Stock.objects.filter(name__in=('AAPL', 'INTC')))
+        testdate = date(2012,6,11)
+        rank = rank_cha(par_type='rank', rule='test', lb=Channel.MONTH, 
+                op='gt', tha=-1000.)
+        for stock in stocks:
+            stock.date_range = (date(2012,6,1), date(2012,6,30))
+            Channel.calculate(stock, date(2012,6,1), date(2012,6,30))
+        channels = Channel.on_date(stocks, testdate, Channel.MONTH)
+        table = rank.get_table(stocks, testdate)
+        self.assertEqual(len(channels), 2)
+        self.assertEqual(len(table), 2)
+        ChannelHistory.export_table(stocks)
+        Channel.objects.all().delete()
+        storage = Channel.storage
+        Channel.storage = Channel.HISTORY
+        try:
+            history_channels = Channel.on_date(stocks, testdate, 
+                    Channel.MONTH)
+            self.assertEqual([(c.stock, c.lookback) for c in 
+                    history_channels], [(c.stock, c.lookback) for c in 
+                    channels])
+            for c, h in zip(channels, history_channels):
+                self.assertAlmostEqual(float(h.close), float(c.close), 2)
+                self.assertAlmostEqual(h.angle, c.angle, 4)
+                self.assertAlmostEqual(h.bottom, c.bottom, 2)
+            history_table = rank.get_table(stocks, testdate)
+            self.assertEqual([row['symbol'] for row in history_table], 
+                    [row['symbol'] for row in table])
+            self.assertEqual(len(Channel.on_date(stocks[:1], testdate)), 
+                    len(Channel.LOOKBACKS))
+            self.assertEqual(Channel.on_date(stocks, date(2012,7,2)), [])
+        finally:
+            Channel.storage = storage
+
+    def test_derived(self):
+        stock = Stock.objects.get(name='INTC')
+        stock.date_range = (date(2012,5,1), date(2012,6,30))
+        data = ChannelData(stock)
+        angles = [data.angle_n(lb).as_list() for lb in Channel.LOOKBACKS]
+        widths = [data.width_n(lb).as_list() for lb in Channel.LOOKBACKS]
+        self.assertEqual(angles[0], data.angle(Channel.YEAR).as_list())
+        self.assertEqual(data.angle_max().as_list(), map(max, zip(*angles)))
+        self.assertEqual(data.angle_min().as_list(), map(min, zip(*angles)))
+        self.assertEqual(data.width_max().as_list(), map(max, zip(*widths)))
+        self.assertEqual(data.width_min().as_list(), map(min, zip(*widths)))
+        lookback = Channel.QUARTER
+        bottom = data.bottom(lookback).as_list()
+        width = data.width(lookback).as_list()
+        top = [b * (1 + 0.01 * w) for b, w in zip(bottom, width)]
+        self.assertEqual(data.top(lookback).as_list(), top)
+        self.assertEqual(data.quality(lookback).as_list(), [a / w for a, w in 
+                zip(data.angle(lookback).as_list(), width)])
+        close = stock.price.close[date(2012,5,1):date(2012,6,30)]
+        self.assertEqual(data.rc(lookback).as_list(), [max(0, min(1, 
+                (c - b) / (t - b))) for c, b, t in zip(close, bottom, top)])
+        self.assertEqual(data.rc(lookback).dates, data.angle(lookback).dates)
+        self.assertAlmostEqual(data.sumangle()[-1], sum(lb * 
+                data.angle(lb)[-1] / 100 for lb in (Channel.SIXWEEKS, 
+                Channel.QUARTER, Channel.SIXMONTHS, Channel.YEAR)))
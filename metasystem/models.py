@@ -21,7 +21,7 @@ from pyutillib.string_utils import random_string, str2dict
 from pyutillib.math_utils import eval_conditions
 
 from pricemanager.models import Pool
-from tradesignal.models import Positions, Trades, Signals #, ExitSignal
+from tradesignal.models import Positions, Trades, Signals, stop_cache
 from equity.models import EquityHistory
 from system.models import System
 from TSB.utils import get_choice
@@ -156,13 +156,17 @@ class MetaSystem(models.Model):
         self.build_structure()
         # the same date range is used for all stocks in the pool:
         self.pool.index.global_date_range = (self.startdate, self.enddate)
+        self.pool.preload_prices(*self.pool.index.price_date_range)
 
 
     def _reset(self):
         '''
-        Clears all positions, trades and equity. Run this before each backtest.
+        Clears all positions, trades, equity and cached stops. Run this before
+        each backtest.
         '''
         self.positions.clear()
+        stop_cache.clear()
+        self.stop_cache_stats = None
         self.trades.clear()
         self.equity.clear(self.startcash)
 
@@ -230,6 +234,8 @@ class MetaSystem(models.Model):
 #            raise SystemExit()
 
         self.trades.extend(self.positions.close_all(today))
+        # keep the hit rate of the stop cache for callers that log it
+        self.stop_cache_stats = stop_cache.stats()
         self.trades.calc_performance(self.startdate, self.enddate, 
                                                 self.positions.max_positions)
         data = self.trades.data
@@ -508,7 +514,7 @@ class Method(models.Model):
         '''
         if not hasattr(self, '_rsl') or self._rsl['date'] != date:
             rsl = self.rank.get_list(date=date, 
-                    stock_list=pool.get_cached_stocklist(date))
+                    stock_list=pool.get_cached_stocklist(date), pool=pool)
             
 #            print "Method.get_ranked_stocklist", date, len(rsl)
             
@@ -15,22 +15,10 @@ from channel.models import Channel
 
 def get_market_channel(self, lb):
     '''
-    Return 
+    Return the fraction of the pool members with a positive <lb> channel angle
     EXPECTS UP, DOWN, but products PERCENTAGES!!
     '''
-    dates = self.index.price.close.dates
-    percentage = []
-    for date in dates:
-        stock_list = self.get_cached_stocklist(date)
-        n_total = len(stock_list)
-
-        if n_total > 0:
-            n_pos = sum(1 if s.price.channel.angle(lb)[date] > 0 
-                    else 0 for s in stock_list)
-            percentage.append(n_pos / n_total)
-        else:
-            percentage.append(0)
-    return DatedList(percentage, dates)
+    return self.pool.market_breadth(lb)
     
 
 #def something(self):
@@ -451,11 +451,12 @@ class exit_tsl(_Exit):
         if (position.method.direction == position.method.LONG) == (
                                             self.reverse == 'ttp'): # long tsl
             at = self.STOP
-            high = max(position.stock.price.high[position.date_entry: date])
+            high = position.stock.price.high.max_since(position.date_entry, 
+                    date)
             price = (1 - self.factor) * high
         else: # short tsl  (long ttp)
             at = self.LIMIT
-            low = min(position.stock.price.low[position.date_entry: date])
+            low = position.stock.price.low.min_since(position.date_entry, date)
             price = (1 + self.factor) * low
         return ExitSignal(position, self.rule, at, price)
 
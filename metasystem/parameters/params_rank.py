@@ -22,6 +22,8 @@ Every rank class MUST:
         - date       datetime instance, the ranked list is calculated using
                      price data on <date> (the day before entry)
         - stock_list list that holds all stocks from the pool on <date>
+        - pool       the Pool of <stock_list>, if it is given the ranking
+                     values may be taken from its PricePanel (see _panel_list)
 
 NOTE: **kwargs is added to the input of all <get_list> methods to future-proof 
 it.
@@ -42,6 +44,7 @@ from __future__ import absolute_import
 from collections import OrderedDict
 import operator
 
+import numpy as np
 import django_tables2 as tables
 
 import TSB.tables as TSBtables
@@ -88,6 +91,19 @@ class _Rank(_Param):
         else:
             return None
 
+    def _panel_list(self, stock_list, panel, values, threshold):
+        '''
+        Returns the ranked stock list from <values>, a row of an array of the
+        pool <panel> with the value of each member on the ranking date.
+        Stocks are valid if their value is <op> <threshold>.
+        '''
+        values = values[[panel.columns[stock.id] for stock in stock_list]]
+        valid = getattr(operator, self.op)(values, threshold)
+        ranked_stocklist = zip(stock_list, values.tolist(), valid.tolist())
+        ranked_stocklist.sort(key=operator.itemgetter(1), 
+                reverse=(self.op == 'gt'))
+        return ranked_stocklist
+
 
 
 class rank_none(_Rank):
@@ -137,7 +153,11 @@ class rank_roc(_Rank):
                 '{}.'.format(self.repr('nd'), self.repr('op'), 
                 self.repr('th'))
 
-    def get_list(self, stock_list, date, **kwargs):
+    def get_list(self, stock_list, date, pool=None, **kwargs):
+        if pool is not None:
+            panel = pool.panel
+            return self._panel_list(stock_list, panel,
+                    panel.stock_roc(self.nd)[panel.row(date)], self.th)
         ranked_stocklist = []
         for stock in stock_list:
             value = stock.price.close.roc(self.nd, date)
@@ -178,8 +198,7 @@ class rank_cha(_Rank):
         return angle, getattr(operator, self.op)(angle, self.tha)
 
     def get_table(self, stock_list, date, **kwargs):
-        channels = Channel.with_close.filter(stock__in=stock_list, date=date,
-                lookback=self.lb)
+        channels = Channel.on_date(stock_list, date, self.lb)
         newlist = []
         for c in channels:
             value, valid = self._get_rank(c.angle)
@@ -214,7 +233,12 @@ class rank_cha(_Rank):
                 attrs = {'class': 'paleblue'}
         return RankTable(**kwargs)
 
-    def get_list(self, stock_list, date, **kwargs):
+    def get_list(self, stock_list, date, pool=None, **kwargs):
+        if pool is not None:
+            panel = pool.panel
+            return self._panel_list(stock_list, panel, 
+                    panel.channel('angle', self.lb)[panel.row(date)], 
+                    self.tha)
         ranked_stocklist = []
         for stock in stock_list:
             value, valid = self._get_rank(
@@ -260,8 +284,7 @@ class rank_chq(_Rank):
         return value, valid
 
     def get_table(self, stock_list, date, **kwargs):
-        channels = Channel.with_close.filter(stock__in=stock_list, date=date,
-                lookback=self.lb)
+        channels = Channel.on_date(stock_list, date, self.lb)
         newlist = []
         for c in channels:
             value, valid = self._get_rank(c.angle, c.width)
@@ -296,7 +319,17 @@ class rank_chq(_Rank):
                 attrs = {'class': 'paleblue'}
         return RankTable(**kwargs)
 
-    def get_list(self, stock_list, date, **kwargs):
+    def get_list(self, stock_list, date, pool=None, **kwargs):
+        if pool is not None:
+            panel = pool.panel
+            row = panel.row(date)
+            angles = panel.channel('angle', self.lb)[row]
+            widths = panel.channel('width', self.lb)[row]
+            # element wise div: 0 / 0 is 0
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = angles / widths
+            values[(angles == 0) & (widths == 0)] = 0
+            return self._panel_list(stock_list, panel, values, self.thq)
         ranked_stocklist = []
         for stock in stock_list:
             value, valid = self._get_rank(
@@ -472,8 +505,7 @@ class rank_chas(_Rank):
         return angle, valid
 
     def get_table(self, stock_list, date, **kwargs):
-        channels = Channel.with_close.filter(stock__in=stock_list, date=date,
-                lookback=self.lb)
+        channels = Channel.on_date(stock_list, date, self.lb)
         newlist = []
         for c in channels:
             value, valid = self._get_rank(c.angle, c.stoploss(), c.close)
@@ -0,0 +1,207 @@
+'''
+pricemanager/indicators/cache.py v0.1 130601
+
+Created on 130601
+
+@author: edwin
+'''
+from __future__ import division
+from __future__ import absolute_import
+
+import os, shutil, tempfile
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+
+from django.conf import settings
+
+
+DEFAULT_MAX_BYTES = 256 * 2**20 # 256 MB
+
+_uids = count()
+
+def new_uid():
+    '''
+    Returns a number that is unique for this process, it is used to identify
+    the owner of cache entries (unlike id(), it is never reused).
+    '''
+    return next(_uids)
+
+
+
+class IndicatorCache(object):
+    '''
+    Process wide cache for indicator values (e.g. a StockPrice with the 20 day
+    sma of a stock).
+
+    Entries are keyed by (owner token, indicator, parameters), where the owner
+    token identifies the price data *and its version*, so entries of data that
+    has changed are never returned (they are evicted when they become the
+    least recently used).
+    If the total size of the cached values exceeds <self.max_bytes>, the least
+    recently used entries are evicted. Set <max_bytes> to None for an unbounded
+    cache. The process wide cache uses settings.INDICATOR_CACHE_MAX_BYTES
+    (DEFAULT_MAX_BYTES if it is not set).
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.clear()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def clear(self):
+        '''
+        Remove all entries and reset the counters.
+        '''
+        self._data = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, owner, key, calculate):
+        '''
+        Returns the value of indicator <key> (a tuple with the indicator name
+        and its parameters) for <owner>, which must have a <cache_token>
+        attribute (e.g. a DatedList or StockPrices instance).
+        If the value is not in the cache, it is calculated by calling
+        <calculate> (without arguments) and stored.
+        '''
+        full_key = (owner.cache_token,) + key
+        try:
+            value, size = self._data.pop(full_key)
+        except KeyError:
+            self.misses += 1
+            value = calculate()
+            size = getattr(value, 'nbytes', 0)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return value
+            self.n_bytes += size
+        else:
+            self.hits += 1
+        self._data[full_key] = (value, size) # (re)insert as most recent
+        self._evict()
+        return value
+
+
+    def _evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        <self.max_bytes>.
+        '''
+        if self.max_bytes is None:
+            return
+        while self.n_bytes > self.max_bytes:
+            unused, (unused, size) = self._data.popitem(last=False)
+            self.n_bytes -= size
+            self.evictions += 1
+
+
+    def stats(self):
+        '''
+        Returns a dict with the cache statistics.
+        '''
+        n_requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'n_items': len(self._data),
+                'n_bytes': self.n_bytes,
+                'hit_rate': self.hits / n_requests if n_requests else None}
+
+
+
+
+class IndicatorStore(object):
+    '''
+    Persistent (on disk) store for indicator arrays, so that indicators do not
+    have to be recalculated in every new process.
+
+    Each array is stored as a .npy file in <directory>/<stock id>/. The file
+    name contains the indicator name, its parameters and a fingerprint of the
+    price data that it was calculated from (see StockPrices.set_arrays), so 
+    changed prices never return old values. Price.insert_prices and 
+    Stock.correct_splits remove the files of the stocks that they change.
+
+    The store is disabled if <directory> is None, by default the directory is
+    settings.INDICATOR_CACHE_DIR.
+    '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+
+    def _path(self, store_key, key):
+        '''
+        Returns the file name for indicator <key> of the series <store_key>,
+        which is a tuple (stock id, series name, fingerprint).
+        '''
+        stock_id, series, fingerprint = store_key
+        name = '_'.join(str(k) for k in key)
+        return os.path.join(self.directory, str(stock_id), '{}.{}.{}.npy'.
+                format(series, name, fingerprint))
+
+
+    def get(self, owner, key, calculate):
+        '''
+        Returns the array with indicator <key> for <owner> (see 
+        IndicatorCache.get). If the store is disabled or <owner> has no 
+        <store_key> (e.g. the series was changed after it was loaded), the
+        array is just calculated.
+        '''
+        store_key = getattr(owner, 'store_key', None)
+        if not self.enabled or store_key is None:
+            return np.asarray(calculate())
+        path = self._path(store_key, key)
+        try:
+            return np.load(path)
+        except (IOError, ValueError):
+            pass
+        value = np.asarray(calculate())
+        self._save(path, value)
+        return value
+
+
+    def _save(self, path, value):
+        '''
+        Save <value> to <path>. The file is written under a temporary name and
+        then renamed, so that other processes never read half written files.
+        '''
+        if value.dtype == object:
+            return
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            pass # the store is only a cache, so this is not an error
+
+
+    def invalidate(self, stock_ids):
+        '''
+        Remove all stored indicators of the stocks with ids <stock_ids>.
+        '''
+        if not self.enabled:
+            return
+        for stock_id in stock_ids:
+            shutil.rmtree(os.path.join(self.directory, str(stock_id)), 
+                    ignore_errors=True)
+
+
+
+indicator_cache = IndicatorCache(getattr(settings, 'INDICATOR_CACHE_MAX_BYTES',
+        DEFAULT_MAX_BYTES))
+indicator_store = IndicatorStore(getattr(settings, 'INDICATOR_CACHE_DIR', None))
@@ -10,16 +10,28 @@ from __future__ import absolute_import
 
 import datetime
 
+import numpy as np
 
-class DatedList(list):
+from pricemanager.indicators.tradingcalendar import TradingCalendar
+from pricemanager.indicators.cache import new_uid
+
+
+class DatedList(object):
     '''
-    This is a standard Python list, but instead of an int, it uses a
-    (datetime)date as its index. This index is stored in the list <self.date>
-    and must be the same length as the list of values.
-    The list can be sliced in the following ways:
-    datelist[startdate:enddate] returns the list of values from startdate to 
+    This behaves like a standard Python list, but instead of an int, it uses a
+    (datetime)date as its index. The dates are not stored in the list, they
+    are in a TradingCalendar <self.calendar> that may be shared by many lists
+    (e.g. all series of a stock), the values start at index <self.start> of the
+    calendar.
+    The values are stored in a (contiguous) numpy array, if <values> already is
+    a numpy array it is used as is, so a DatedList can be a view onto a larger
+    array (e.g. one column of the price data of a stock).
+    The list can be sliced in the following ways (a slice is a DatedListView,
+    i.e. it shares its values with this list, use copy() or as_list() if an
+    independent list is needed):
+    datelist[startdate:enddate] returns the list of values from startdate to
         enddate, including both startdate and enddate (if available)
-    datelist[date:length] (where <length> is an int) returns a list of 
+    datelist[date:length] (where <length> is an int) returns a list of
         <length> values, starting at <date>. If <length> is a negative number
         a list is returned from <length> items before <date> to <date>
     datelist[date] returns the value on <date> or the most recent value
@@ -29,36 +41,139 @@ class DatedList(list):
     '''
 
 
-    def __init__(self, values, dates):
+    def __init__(self, values, dates, start=0):
         '''
-        Constructor takes a list of dates and a list of values as input. These
-        two lists must have equal lengths.
+        Constructor takes a list (or numpy array) of values and a list of dates
+        or a TradingCalendar as input. 
+        A list of dates must have the same length as the values, it is not
+        copied but it becomes the calendar of this list. 
+        If <dates> is a calendar, the values start at index <start> of the
+        calendar and the calendar may be longer than the values.
         '''
-        if len(values) != len(dates):
+        if isinstance(dates, TradingCalendar):
+            if start < 0 or start + len(values) > len(dates):
+                raise ValueError, 'values do not fit in the calendar'
+        elif len(values) != len(dates):
             raise ValueError, 'value and date lists must be the same length'
-        self.dates = dates
-        list.__init__(self, values)
+        else:
+            dates = TradingCalendar(dates)
+            start = 0
+        self.calendar = dates
+        self.start = start
+        self._buffer = self._values = as_array(values)
+        self._version = 0
+
+
+    @property
+    def dates(self):
+        '''
+        Returns the dates of this list: the calendar itself if the values cover
+        the entire calendar, otherwise a list with the dates of the values.
+        '''
+        stop = self.start + len(self._values)
+        if self.start == 0 and stop == len(self.calendar):
+            return self.calendar
+        return self.calendar[self.start:stop]
+    @dates.setter
+    def dates(self, dates):
+        if not isinstance(dates, TradingCalendar):
+            dates = TradingCalendar(dates)
+        self.calendar = dates
+        self.start = 0
+        self._version += 1
+
+
+    @property
+    def cache_token(self):
+        '''
+        Returns a tuple that identifies this list and the version of its data
+        for the indicator cache. The version changes if the list is changed.
+        '''
+        if not hasattr(self, '_uid'):
+            self._uid = new_uid()
+        return (self._uid, self._version)
+
+
+    @property
+    def store_key(self):
+        '''
+        Returns the key of this list in the persistent indicator store, or None
+        if it has no key or if it was changed after the key was set.
+        '''
+        store_key, version = getattr(self, '_store_key', (None, None))
+        if version != self._version:
+            return None
+        return store_key
+    @store_key.setter
+    def store_key(self, store_key):
+        self._store_key = (store_key, self._version)
+
+
+    @property
+    def nbytes(self):
+        return self._values.nbytes
+
+
+    def _position(self, date):
+        '''
+        Returns the index of <date> or None if <date> is not in self.dates.
+        '''
+        index = self.calendar.position(date)
+        if index is None or not 0 <= index - self.start < len(self._values):
+            return None
+        return index - self.start
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def __iter__(self):
+        return iter(self._values.tolist())
+
+
+    def __nonzero__(self):
+        return len(self._values) > 0
+
+
+    def __eq__(self, other):
+        '''
+        A DatedList is equal to any sequence with the same values.
+        '''
+        try:
+            return self._values.tolist() == list(other)
+        except TypeError:
+            return False
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __repr__(self):
+        return 'DatedList({!r})'.format(self._values.tolist())
 
 
     def __contains__(self, date):
         '''
         Returns True if date is in self.dates.
         '''
-        return date in self.dates
+        return self._position(date) is not None
 
 
     def __getitem__(self, date):
         '''
         Retrieve an item from the list:
             datedlist[date]
-        Slicing is supported. If slices are used, a standard Python list is
-        returned. The following slicing operations are supported:
+        Slicing is supported. If slices are used, a DatedListView is returned
+        that shares its values with this list, so no values are copied.
+        The following slicing operations are supported:
 
             datedlist[date_from : date_to]
                 NOTE: unlike slicing of a standard list, <date_to> is inclusive!
 
             datedlist[date : n_days]
-                where n_days < 0 returns a list of days *before* <date> and 
+                where n_days < 0 returns a list of days *before* <date> and
                 n_days > 0 a list of n_days *after* <date>.
 
             datedlist[i_from, i_to]
@@ -70,31 +185,31 @@ class DatedList(list):
             if isinstance(date.start, datetime.date):
                 i_start = self.index(date.start)
                 if isinstance(date.stop, datetime.date):
-                    i_stop = min(self.index(date.stop) + 1, len(self.dates))
+                    i_stop = min(self.index(date.stop) + 1, len(self._values))
                 elif isinstance(date.stop, int):
                     if not date.stop:
                         raise ValueError, 'slice[date:0] has no meaning'
                     if date.stop < 0:
                         i_start += 1
                     i_stop = i_start + date.stop
-                    i_start, i_stop = min(i_start, i_stop), max(i_start, 
+                    i_start, i_stop = min(i_start, i_stop), max(i_start,
                                                                         i_stop)
                     i_start = max(i_start, 0)
-                    i_stop = min(i_stop, len(self.dates))
+                    i_stop = min(i_stop, len(self._values))
                 else:
                     raise TypeError('If first argument of slice is datetime '\
                             'object, the second must be datetime or int.')
-            elif isinstance(date.start, int) and isinstance(date.stop, int):
-                i_start, i_stop = date.start, date.stop
-            else:
+            elif isinstance(date.stop, datetime.date):
                 raise TypeError('Slice with two arguments must be [int:int], '\
                         '[datetime:datetime] or [datetime:int]')
-            return [list.__getitem__(self, i) for i in range(i_start, i_stop)]
+            else:
+                # standard python slicing
+                return DatedListView(self, date)
+            return DatedListView(self, slice(i_start, i_stop))
         elif isinstance(date, datetime.date):
-            index = self.index(date)
-            return list.__getitem__(self, index)
-        elif isinstance(date, int):
-            return list.__getitem__(self, date)
+            return self._values.item(self.index(date))
+        elif isinstance(date, (int, long, np.integer)):
+            return self._values.item(date)
         else:
             raise TypeError('Invalid argument type.')
 
@@ -109,24 +224,15 @@ class DatedList(list):
         If <date> is later than the latest date in self.dates the return value
         is the index of the most recent date.
         '''
-        if date in self.dates:
-            index = self.dates.index(date)
-        elif date < self.dates[0]:
-            index = 0
-        elif date > self.dates[-1]:
-            index = len(self.dates) - 1
-        else:
-            while date not in self.dates:
-                date -= datetime.timedelta(days=1)
-            index = self.dates.index(date)
-        return index
+        index = self.calendar.index(date) - self.start
+        return min(max(index, 0), len(self._values) - 1)
 
 
     def latest_date_before(self, date):
         '''
         returns the latest date from self.dates that is <= <date>
         '''
-        return self.dates[self.index(date)]
+        return self.calendar[self.start + self.index(date)]
 
 
     def offset(self, date, offset):
@@ -137,8 +243,8 @@ class DatedList(list):
         '''
         index = self.index(date) + offset
         index = max(index, 0)
-        index = min(index, len(self.dates) - 1)
-        return list.__getitem__(self, index)
+        index = min(index, len(self._values) - 1)
+        return self._values.item(index)
 
 
     def delta(self, fromdate, todate):
@@ -157,8 +263,8 @@ class DatedList(list):
         '''
         index = self.index(date) + n_days
         index = max(0, index)
-        index = min(index, len(self.dates) - 1)
-        return self.dates[index]
+        index = min(index, len(self._values) - 1)
+        return self.calendar[self.start + index]
 
 
     def get_dates(self, fromdate, todate):
@@ -166,9 +272,9 @@ class DatedList(list):
         Return a list of dates from <self.dates> between <fromdate> and <todate>
         (inclusive)
         '''
-        i_from = self.index(fromdate)
-        i_to = self.index(todate)
-        return self.dates[i_from:i_to + 1]
+        i_from = self.start + self.index(fromdate)
+        i_to = self.start + self.index(todate)
+        return self.calendar[i_from:i_to + 1]
 
 
     def on(self, date):
@@ -177,39 +283,138 @@ class DatedList(list):
         NOTE that this behaves differently from datedlist[<date>] if <date> is
         *not* in the date list.
         '''
-        if date in self.dates:
-            index = self.dates.index(date)
-            return list.__getitem__(self, index)
-        else:
+        index = self._position(date)
+        if index is None:
             return None
+        return self._values.item(index)
 
 
     def append(self, (date, value)):
         '''
         Appends a date, value tuple to the list.
+        The values array is over-allocated, so appending is amortised O(1).
         '''
         if isinstance(date, datetime.date):
-            self.dates.append(date)
-            super(DatedList, self).append(value)
+            size = len(self._values)
+            self._extend_dates([date])
+            self._reserve(size + 1, np.asarray(value).dtype)
+            self._buffer[size] = value
+            self._values = self._buffer[:size + 1]
+            self._version += 1
         else:
             raise ValueError('append needs a (date, value) tuple')
 
 
     def extend(self, extension):
         '''
-        Appends <extension> to the DatedList, <extension> must also be a 
+        Appends <extension> to the DatedList, <extension> must also be a
         DatedList.
         '''
         if isinstance(extension, DatedList):
-            self.dates.extend(extension.dates)
-            super(DatedList, self).extend(extension)
+            size = len(self._values)
+            new_size = size + len(extension)
+            self._extend_dates(extension.dates)
+            self._reserve(new_size, extension.values.dtype)
+            self._buffer[size:new_size] = extension.values
+            self._values = self._buffer[:new_size]
+            self._version += 1
         else:
             raise ValueError('the argument to extend must be a DatedList')
 
 
+    def _extend_dates(self, dates):
+        '''
+        Make sure that the calendar continues with <dates> after the last value.
+        If the calendar already has other dates there (because another list 
+        that shares the calendar was extended), this list gets a new calendar.
+        '''
+        position = self.start + len(self._values)
+        dates = list(dates)
+        if self.calendar[position:position + len(dates)] != dates:
+            if position < len(self.calendar):
+                self.calendar = TradingCalendar(self.calendar[self.start:
+                        position])
+                self.start = 0
+            self.calendar.extend(dates)
+
+
+    def _reserve(self, size, dtype):
+        '''
+        Make sure that the buffer can hold <size> values of <dtype>. A new
+        buffer is allocated if it is too small or if its type cannot hold
+        <dtype>. The buffer is never shared with the array that the DatedList
+        was created from.
+        '''
+        dtype = np.result_type(self._buffer.dtype, dtype)
+        if size > len(self._buffer) or dtype != self._buffer.dtype:
+            buffer_ = np.empty(max(size, 2 * len(self._buffer), 16),
+                    dtype=dtype)
+            buffer_[:len(self._values)] = self._values
+            self._buffer = buffer_
+            self._values = self._buffer[:len(self._values)]
+
+
+    @property
+    def values(self):
+        '''
+        Returns the numpy array with the values. This is *not* a copy, so it
+        must not be modified.
+        '''
+        return self._values
+
+
     def as_list(self):
         '''
         Returns a standard Python list with values, dates are ignored.
         '''
-        return self[:]
+        return self._values.tolist()
 
+
+    def copy(self):
+        '''
+        Returns a DatedList with a copy of the values and dates, so that it
+        does not share any data with this list.
+        '''
+        return DatedList(self._values.copy(), list(self.dates))
+
+
+
+class DatedListView(DatedList):
+    '''
+    A DatedList that is a window onto (a slice of) another DatedList. The 
+    values are a numpy view onto the values of the parent and the view shares
+    the calendar of the parent (unless the slice has a step).
+    Appending to or extending a view does not affect the values of the parent,
+    because a new buffer is allocated for the values.
+    '''
+
+    def __init__(self, parent, window):
+        '''
+        <window> is a slice object with integer (or None) arguments.
+        '''
+        self._buffer = self._values = parent.values[window]
+        start, unused, step = window.indices(len(parent))
+        if step == 1:
+            self.calendar = parent.calendar
+            self.start = parent.start + min(start, len(parent))
+        else:
+            self.calendar = TradingCalendar(list(parent.dates[window]))
+            self.start = 0
+        self._version = 0
+
+
+
+def as_array(values):
+    '''
+    Returns <values> as a one dimensional numpy array. Numpy arrays are
+    returned as is (no copy), lists of numbers are converted to float64 or
+    int64 arrays, anything else (e.g. None or tuples) is stored as objects.
+    '''
+    if isinstance(values, np.ndarray):
+        return values
+    array = np.array(values)
+    if array.ndim != 1 or array.dtype.kind not in 'biuf':
+        array = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            array[i] = value
+    return array
@@ -8,7 +8,14 @@ Created on 120906
 from __future__ import division
 from __future__ import absolute_import
 
-from pricemanager.indicators.single import StockPrice, calc_ema
+import hashlib
+
+import numpy as np
+
+from pricemanager.indicators.single import StockPrice, calc_ema, ema_array,\
+        rolling_max, rolling_min
+from pricemanager.indicators.tradingcalendar import TradingCalendar
+from pricemanager.indicators.cache import indicator_cache, indicator_store
 
 from channel.models import ChannelData
 
@@ -32,13 +39,106 @@ class StockPrices(object):
         list of datetime's   self.date
         PriceList of floats  self.open/high/low/close
         PriceList of ints    self.volume
+
+    The open/high/low/close prices are stored in one contiguous float64 array
+    with shape (4, n_dates) and volume in an int64 array, the PriceLists are
+    views onto those arrays. All PriceLists (and the indicators derived from
+    them) share one TradingCalendar: self.calendar
     '''
+    OHLC = ('open', 'high', 'low', 'close')
 
 
     def __init__(self, stock):
         self.stock = stock
 
 
+    def load(self, rows, calendar=None):
+        '''
+        Fill the price lists from <rows>, which is a sequence of tuples
+        (date, open, high, low, close, volume) ordered by date, e.g. the result
+        of a values_list query on the Price table.
+        If the dates in <rows> are the same as those of the TradingCalendar
+        <calendar> (e.g. the calendar of the pool index), that calendar is used
+        instead of a new one.
+        '''
+        if rows:
+            columns = zip(*rows)
+            dates = list(columns[0])
+            ohlc = np.array(columns[1:5], dtype=np.float64)
+            volume = np.array(columns[5], dtype=np.int64)
+        else:
+            dates = []
+            ohlc = np.empty((4, 0), dtype=np.float64)
+            volume = np.empty(0, dtype=np.int64)
+        if calendar is not None and calendar == dates:
+            dates = calendar
+        self.set_arrays(dates, ohlc, volume)
+
+
+    def set_arrays(self, dates, ohlc, volume):
+        '''
+        Set the price lists from the list (or TradingCalendar) <dates>, the 
+        (4, n_dates) array <ohlc> and the array <volume>. The arrays are not
+        copied.
+        If the indicator store is enabled, each list gets a store key with a
+        fingerprint of the price data, so that its indicators can be stored.
+        '''
+        if not isinstance(dates, TradingCalendar):
+            dates = TradingCalendar(dates)
+        self.calendar = dates
+        self._ohlc = ohlc
+        self._volume = volume
+        for row, column in enumerate(self.OHLC):
+            setattr(self, column, StockPrice(ohlc[row], dates))
+        self.volume = StockPrice(volume, dates)
+        self._fingerprint = None
+        stock_id = getattr(self.stock, 'id', None)
+        if indicator_store.enabled and stock_id is not None:
+            self._fingerprint = self.fingerprint()
+            for column in self.OHLC + ('volume',):
+                getattr(self, column).store_key = (stock_id, column, 
+                        self._fingerprint)
+
+
+    def fingerprint(self):
+        '''
+        Returns a hash of the dates and prices.
+        '''
+        sha = hashlib.sha1(self.calendar.ordinals[:len(self._volume)])
+        sha.update(np.ascontiguousarray(self._ohlc))
+        sha.update(np.ascontiguousarray(self._volume))
+        return sha.hexdigest()
+
+
+    @property
+    def store_key(self):
+        '''
+        Returns the key of the price data in the indicator store, or None if
+        the prices have no key (anymore).
+        '''
+        if self._fingerprint is None or any(getattr(self, column).store_key is 
+                None for column in self.OHLC):
+            return None
+        return (self.stock.id, 'prices', self._fingerprint)
+
+
+    def _cached(self, key, calculate):
+        '''
+        Returns the StockPrice with indicator <key>, see StockPrice._cached.
+        '''
+        return indicator_cache.get(self, key, lambda: StockPrice(
+                indicator_store.get(self, key, calculate), self.calendar))
+
+
+    @property
+    def cache_token(self):
+        '''
+        Returns the token that identifies the price data (and its version) in
+        the indicator cache.
+        '''
+        return tuple(getattr(self, column).cache_token for column in self.OHLC)
+
+
     @property
     def channel(self):
         if not hasattr(self, '_channel'):
@@ -50,21 +150,26 @@ class StockPrices(object):
         '''
         Return the <n_days> Williams%R indicator. WR values range from 0 to 
         -100.
+        The entire list is calculated (and kept in cache), also if only the
+        value on <date> is requested.
         '''
         if not isinstance(n_days, int):
             raise TypeError, 'n_days must be an integer'
         if n_days < 1:
             raise ValueError, 'n_days must be > 0'
-        wr = []
-        dates = self.close.dates if date is None else [date]
-        for date in dates:
-            high = max(self.high[date:-n_days])
-            low = min(self.low[date:-n_days])
-            wr.append(-100 * (high - self.close[date]) / (high - low))
-        if len(wr) == 1:
+        wr = self._cached(('WR', n_days), lambda: self._calc_wr(n_days))
+        if date is not None:
+            return wr[date]
+        elif len(wr) == 1:
             return wr[0]
         else:
-            return StockPrice(wr, self.close.dates)
+            return wr
+
+
+    def _calc_wr(self, n_days):
+        high = rolling_max(self.high.values, n_days)
+        low = rolling_min(self.low.values, n_days)
+        return -100 * (high - self.close.values) / (high - low)
 
 
     def atr(self, n_days, date_=None, as_price=True):
@@ -74,31 +179,28 @@ class StockPrices(object):
         False in order to return a list with the ATR as percentage of the close
         price.
         Because of the EMA this indicator cannot be calculated for a single
-        <date_>, the entire list is kept in cache.
-NOTE: the cache is a potential risk for memory overflows.
-        '''
-        if not hasattr(self, '_cache'):
-            self._cache = {}
-        key = ('ATR', n_days, as_price)
-        if key not in self._cache:
-            if not isinstance(n_days, int):
-                raise TypeError, 'n_days must be an integer'
-            if n_days < 1:
-                raise ValueError, 'n_days must be > 0'
-            tr = []
-            for date in self.close.dates:
-                yest_close = self.close.offset(date, -1)
-                day_range = max(yest_close, self.high[date]) - min(yest_close, 
-                                                                self.low[date])
-                if not as_price:
-                    day_range = day_range / self.close[date]
-                tr.append(day_range)
-            self._cache[key] = StockPrice(calc_ema(tr, n_days), 
-                                                        self.close.dates)
+        <date_>, the entire list is kept in the (bounded) indicator cache.
+        '''
+        if not isinstance(n_days, int):
+            raise TypeError, 'n_days must be an integer'
+        if n_days < 1:
+            raise ValueError, 'n_days must be > 0'
+        atr = self._cached(('ATR', n_days, as_price), 
+                lambda: self._calc_atr(n_days, as_price))
         if date_:
-            return self._cache[key][date_]
+            return atr[date_]
         else:
-            return self._cache[key]
+            return atr
+
+
+    def _calc_atr(self, n_days, as_price):
+        close = self.close.values
+        yest_close = close[np.maximum(np.arange(len(close)) - 1, 0)]
+        tr = np.maximum(yest_close, self.high.values) - np.minimum(
+                yest_close, self.low.values)
+        if not as_price:
+            tr = tr / close
+        return ema_array(tr, n_days)
 
 
     def dma(self, n_points, mpl=0.5, n_ma=None, date=None):
@@ -106,37 +208,55 @@ NOTE: the cache is a potential risk for memory overflows.
         Dynamic Moving Average. Period is based on atr
         Default multiplier (mpl) = 0.5, so we are looking at a range of 1 atr
         (0.5 above, 0.5 below).
+        If <date> is not specified, the entire list is calculated and kept in
+        the indicator cache.
         '''
         if not isinstance(n_points, int):
             raise TypeError, 'n_points must be an integer'
         if n_points < 1:
             raise ValueError, 'n_points must be > 0'
+        if date is not None:
+            return self._calc_dma(n_points, mpl, [self.close.index(date)])[0]
+        dma = self._cached(('DMA', n_points, mpl, n_ma), lambda: 
+                self._calc_dma(n_points, mpl, range(len(self.close)), n_ma))
+        if len(dma) == 1:
+            return dma[0]
+        else:
+            return dma
+
+
+    def _calc_dma(self, n_points, mpl, i_starts, n_ma=None):
+        '''
+        Returns a list with the dma on each index in <i_starts>, smoothened
+        with an <n_ma> day ema if <n_ma> is set.
+        '''
+        # the walk back from each date depends on the previous step, so this
+        #   can not be vectorised; it works on plain lists instead.
+        close = self.close.as_list()
+        high = self.high.as_list()
+        low = self.low.as_list()
+        atr_list = self.atr(10).as_list()
         dma = []
-        dates = self.close.dates if date is None else [date]
-        for startdate in dates:
-            startprice = self.close[startdate]
-            i_start = self.close.index(startdate)
+        for i_start in i_starts:
+            startprice = close[i_start]
             i = 0
-            for date in self.close.dates[i_start::-1]:
-                atr = mpl * self.atr(10)[date]
-                if self.low[date] <= startprice - atr:
-                    factor = (startprice - self.low[date]) // atr
+            for i_date in range(i_start, -1, -1):
+                atr = mpl * atr_list[i_date]
+                if low[i_date] <= startprice - atr:
+                    factor = (startprice - low[i_date]) // atr
                     startprice -= factor * atr
                     i += factor
-                elif self.high[date] > startprice + atr:
-                    factor = (self.high[date] - startprice) // atr
+                elif high[i_date] > startprice + atr:
+                    factor = (high[i_date] - startprice) // atr
                     startprice += factor * atr
                     i += factor
                 if i >= n_points:
                     break
-            ma_list = self.close[date:startdate]
+            ma_list = close[i_date:i_start + 1]
             dma.append(sum(ma_list)/len(ma_list))
-        if len(dma) == 1:
-            return dma[0]
-        else:
-            if n_ma: #smoothen if desired
-                dma = calc_ema(dma, n_ma)
-            return StockPrice(dma, self.close.dates)
+        if n_ma and len(dma) > 1: #smoothen if desired
+            dma = calc_ema(dma, n_ma)
+        return dma
 
 
 #    def mc(self, n_ma, n_atr, trend_zones, vol_zones, trend_th, vol_th, 
@@ -0,0 +1,152 @@
+'''
+pricemanager/indicators/panel.py v0.1 130601
+
+Created on 130601
+
+@author: edwin
+'''
+from __future__ import division
+from __future__ import absolute_import
+
+import numpy as np
+
+from pricemanager.indicators.datedlist import DatedList
+
+
+class PricePanel(object):
+    '''
+    Holds the data of all members of a pool in 2-D arrays with one row per date
+    of the pool calendar and one column per stock, so that cross-sectional
+    operations (e.g. the roc of all members on a date) are single numpy
+    operations.
+
+    The value of a stock on a date is the same as <datedlist>[date], i.e. the
+    value on the latest date before <date> if the stock has no value on <date>.
+    Stocks without any values are NaN.
+
+    <self.mask> is a boolean array with the same shape that is True where the
+    stock is a member of the pool on that date.
+    '''
+    FIELDS = ('open', 'high', 'low', 'close', 'volume')
+
+
+    def __init__(self, calendar, member_list):
+        '''
+        <calendar> is the TradingCalendar of the pool (index) and <member_list>
+        a list of tuples (stock, startdate, enddate), see Pool._set_cache. A
+        stock may have multiple entries with different date ranges.
+        '''
+        self.calendar = calendar
+        self.stocks = []
+        self.columns = {}
+        for stock, unused, unused in member_list:
+            if stock.id not in self.columns:
+                self.columns[stock.id] = len(self.stocks)
+                self.stocks.append(stock)
+        ordinals = calendar.ordinals
+        self.mask = np.zeros((len(calendar), len(self.stocks)), dtype=bool)
+        for stock, startdate, enddate in member_list:
+            is_member = ordinals >= startdate.toordinal()
+            if enddate:
+                is_member &= ordinals <= enddate.toordinal()
+            self.mask[:, self.columns[stock.id]] |= is_member
+        self._data = {}
+
+
+    def __getattr__(self, name):
+        '''
+        Returns the array with the price field <name> (e.g. panel.close).
+        '''
+        if name in self.FIELDS:
+            return self.get(name, lambda stock: getattr(stock.price, name))
+        raise AttributeError(name)
+
+
+    def get(self, key, get_series):
+        '''
+        Returns the (n_dates, n_stocks) float array that is stored as <key>.
+        If it does not exist yet, it is built from the DatedList that the
+        function <get_series> returns for each stock.
+        '''
+        if key not in self._data:
+            data = np.empty(self.mask.shape, dtype=np.float64)
+            for column, stock in enumerate(self.stocks):
+                data[:, column] = self._align(get_series(stock))
+            self._data[key] = data
+        return self._data[key]
+
+
+    def channel(self, field, lookback):
+        '''
+        Returns the array with channel <field> (e.g. 'angle') for <lookback>.
+        '''
+        return self.get(('channel', field, lookback),
+                lambda stock: getattr(stock.price.channel, field)(lookback))
+
+
+    def _align(self, series):
+        '''
+        Returns an array with the values of the DatedList <series> on each date
+        of the panel calendar. <series> may also be a single value (e.g. the
+        roc of a stock with one price), which then holds for all dates.
+        '''
+        if not isinstance(series, DatedList):
+            return series
+        if not len(series):
+            return np.nan
+        ordinals = series.calendar.ordinals[series.start:series.start +
+                len(series)]
+        indices = np.searchsorted(ordinals, self.calendar.ordinals, 'right')
+        indices = np.clip(indices - 1, 0, len(series) - 1)
+        values = series.values
+        if values.dtype.kind not in 'biuf':
+            values = np.array(series.as_list(), dtype=np.float64)
+        return values[indices]
+
+
+    def row(self, date):
+        '''
+        Returns the row index of <date>, see TradingCalendar.index
+        '''
+        return self.calendar.index(date)
+
+
+    def members(self, date):
+        '''
+        Returns the list of stocks that are a member of the pool on <date>.
+        '''
+        row = self.mask[self.row(date)]
+        return [stock for stock, member in zip(self.stocks, row) if member]
+
+
+    def roc(self, n_days, date):
+        '''
+        Returns an array with the <n_days> rate of change in percent of all
+        stocks on <date>. The offset is <n_days> dates of the pool calendar.
+        '''
+        row = self.row(date)
+        close = self.close
+        return 100 * (close[row] / close[max(row - n_days, 0)] - 1)
+
+
+    def stock_roc(self, n_days):
+        '''
+        Returns the array with the <n_days> rate of change in percent of all
+        stocks, where the offset is <n_days> dates of the stock itself, i.e.
+        the same values as stock.price.close.roc(n_days, date).
+        '''
+        return self.get(('roc', n_days),
+                lambda stock: stock.price.close.roc(n_days))
+
+
+    def fraction(self, condition):
+        '''
+        Returns a DatedList with, for each date, the fraction of the members
+        for which the boolean (n_dates, n_stocks) array <condition> is True,
+        e.g. panel.fraction(panel.channel('angle', 252) > 0).
+        The fraction is 0 on dates without members.
+        '''
+        n_members = self.mask.sum(axis=1)
+        n_true = (condition & self.mask).sum(axis=1)
+        fractions = n_true / np.maximum(n_members, 1)
+        return DatedList(fractions, self.calendar)
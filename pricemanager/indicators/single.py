@@ -9,8 +9,19 @@ Created on 120906
 from __future__ import division
 from __future__ import absolute_import
 
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
 from pyutillib.math_utils import div
 from pricemanager.indicators.datedlist import DatedList
+from pricemanager.indicators.cache import indicator_cache, indicator_store
+
+
+DRAWDOWN_CHUNK = 1024 # max number of windows per numpy operation in drawdown
 
 
 def drawdown(dd_list):
@@ -35,15 +46,99 @@ def calc_ema(in_list, n_days):
     list will have the same length, so the first n_days * x items will not be
     accurate.
     '''
+    return ema_array(in_list, n_days).tolist()
+
+
+def ema_array(values, n_days):
+    '''
+    Returns a numpy array with the exponential moving average of <values> (a
+    list or numpy array), see calc_ema.
+    The recursion is done by scipy's lfilter if scipy is installed.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return values
     new_mpl = 2 / (n_days + 1)
     prev_mpl = 1 - new_mpl
-    ema = []
-    ma_list = in_list[:n_days]
+    ma_list = values[:n_days].tolist()
     avg = sum(ma_list)/len(ma_list)
-    for item in in_list:
+    if lfilter is not None:
+        return lfilter([new_mpl], [1, -prev_mpl], values, 
+                zi=[prev_mpl * avg])[0]
+    ema = []
+    for item in values.tolist():
         avg = prev_mpl * avg + new_mpl * item
         ema.append(avg)
-    return ema
+    return np.array(ema)
+
+
+def _windows(values, n_days):
+    '''
+    Returns a (len(values), n_days) array (a strided view, so no data is
+    copied) with in each row the <n_days> values up to and including that 
+    index. The windows of the first n_days - 1 rows are padded with the first
+    value.
+    '''
+    padded = np.concatenate((np.repeat(values[:1], n_days - 1), values))
+    stride = padded.strides[0]
+    return as_strided(padded, shape=(len(values), n_days), 
+            strides=(stride, stride))
+
+
+def _rolling_extreme(values, n_days, ufunc):
+    '''
+    Returns an array with ufunc (np.maximum or np.minimum) applied to the
+    <n_days> values up to and including each index of the array <values>. The
+    first n_days - 1 windows are shorter.
+    This is the van Herk/Gil-Werman algorithm: the values are split in blocks
+    of <n_days>, each window is covered by the suffix of one block and the 
+    prefix of the next, so it takes O(n) operations for any <n_days>.
+    '''
+    padded = np.concatenate((np.repeat(values[:1], n_days - 1), values))
+    n_blocks = -(-len(padded) // n_days)
+    blocks = np.empty(n_blocks * n_days, dtype=padded.dtype)
+    blocks[:len(padded)] = padded
+    blocks[len(padded):] = padded[-1:]
+    blocks = blocks.reshape(n_blocks, n_days)
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    n_values = len(values)
+    return ufunc(suffix[:n_values], prefix[n_days - 1:n_days - 1 + n_values])
+
+
+def rolling_max(values, n_days):
+    '''
+    Returns an array with the maximum of the <n_days> values up to and 
+    including each index of the array <values>.
+    '''
+    return _rolling_extreme(values, n_days, np.maximum)
+
+
+def rolling_min(values, n_days):
+    '''
+    Returns an array with the minimum of the <n_days> values up to and 
+    including each index of the array <values>.
+    '''
+    return _rolling_extreme(values, n_days, np.minimum)
+
+
+def rolling_drawdown(values, n_days):
+    '''
+    Returns an array with, for each index of the array <values>, the drawdown
+    (see drawdown) of the <n_days> values up to and including that index.
+    The drawdown of a window is not a plain extreme of it, so this is 
+    O(n * n_days), in chunks of DRAWDOWN_CHUNK windows per numpy operation.
+    '''
+    windows = _windows(values, n_days)
+    result = np.empty(len(values))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(values), DRAWDOWN_CHUNK):
+            chunk = windows[start:start + DRAWDOWN_CHUNK]
+            highs = np.maximum(np.maximum.accumulate(chunk, axis=1), 0)
+            ratios = np.where(highs > 0, chunk / highs, 1)
+            max_dd = np.minimum(ratios.min(axis=1), 1)
+            result[start:start + DRAWDOWN_CHUNK] = 100. * (1 - max_dd)
+    return result
 
 
 class StockPrice(DatedList):
@@ -55,6 +150,17 @@ class StockPrice(DatedList):
     '''
 
 
+    def _cached(self, key, calculate):
+        '''
+        Returns the StockPrice with indicator <key> from the indicator cache.
+        If it is not in the cache, the array is loaded from the indicator store
+        or calculated with <calculate> (which returns an array).
+        '''
+        return indicator_cache.get(self, key, lambda: StockPrice(
+                indicator_store.get(self, key, calculate), self.calendar,
+                self.start))
+
+
     def roc(self, n_days, date=None):
         '''
         Returns the <n_days> Rate Of Change on <date> in percent.
@@ -67,35 +173,36 @@ class StockPrice(DatedList):
             raise TypeError, 'n_days must be an integer'
         if n_days < 1:
             raise ValueError, 'n_days must be > 0'
-        roc = []
-        dates = self.dates if date is None else [date]
-        for date in dates:
-            roc.append(100 * (self[date]/self.offset(date, -n_days) - 1))
+        if date is not None:
+            return 100 * (self[date]/self.offset(date, -n_days) - 1)
+        values = self.values
+        i_back = np.maximum(np.arange(len(values)) - n_days, 0)
+        roc = 100 * (values / values[i_back] - 1)
         if len(roc) == 1:
-            return roc[0]
+            return roc.item(0)
         else:
-            return StockPrice(roc, self.dates)
+            return StockPrice(roc, self.calendar, self.start)
 
 
     def ema(self, n_days, date_=None, cache=True):
         '''
         Returns the <n_days> exponential moving average.
+        The list is kept in the indicator cache, unless <cache> is False.
         '''
-        if not hasattr(self, '_cache'):
-            self._cache = {}
-        if n_days not in self._cache:
-            if not isinstance(n_days, int):
-                raise TypeError, 'n_days must be an integer'
-            if n_days < 1:
-                raise ValueError, 'n_days must be > 0'
-            ema = calc_ema(self, n_days)
-            if not cache:
-                return StockPrice(ema, self.dates)
-            self._cache[n_days] = StockPrice(ema, self.dates)
+        if not isinstance(n_days, int):
+            raise TypeError, 'n_days must be an integer'
+        if n_days < 1:
+            raise ValueError, 'n_days must be > 0'
+        if cache:
+            ema = self._cached(('EMA', n_days), 
+                    lambda: ema_array(self.values, n_days))
+        else:
+            ema = StockPrice(ema_array(self.values, n_days), self.calendar,
+                    self.start)
         if date_:
-            return self._cache[n_days][date_]
+            return ema[date_]
         else:
-            return self._cache[n_days]
+            return ema
 
 
     def sma(self, n_days, date_=None):
@@ -104,36 +211,48 @@ class StockPrice(DatedList):
         If <date> is not specified, a PricesList with the <n_days> simple moving
         average is returned.
         '''
-        if not hasattr(self, '_cache'):
-            self._cache = {}
-        if n_days not in self._cache:
-            if not isinstance(n_days, int):
-                raise TypeError, 'n_days must be an integer'
-            if n_days < 1:
-                raise ValueError, 'n_days must be > 0'
-
-            sma = []
-#            for date in self.dates:
-#                ma_list = self[date:-n_days]
-#                sma.append(sum(ma_list)/len(ma_list))
-#new
-            ma_sum = sum(self[:n_days])
-            ma = ma_sum / n_days
-            for date in self.dates[0:n_days]:
-                sma.append(ma)
-            for date in self.dates[n_days:]:
-                ma_sum = ma_sum + self[date] - self.offset(date, -n_days)
-                sma.append(ma_sum/n_days)
-            self._cache[n_days] = StockPrice(sma, self.dates)
+        if not isinstance(n_days, int):
+            raise TypeError, 'n_days must be an integer'
+        if n_days < 1:
+            raise ValueError, 'n_days must be > 0'
+        sma = self._cached(('SMA', n_days), lambda: self._calc_sma(n_days))
         if date_:
-            return self._cache[n_days][date_]
+            return sma[date_]
         else:
-            return self._cache[n_days]
-#/new
-#        if len(sma) == 1:
-#            return sma[0]
-#        else:
-#            return StockPrice(sma, self.dates)
+            return sma
+
+
+    def _calc_sma(self, n_days):
+        values = self.values
+        sma = np.empty(len(values))
+        sma[:n_days] = sum(values[:n_days].tolist()) / n_days
+        cumsum = np.cumsum(values, dtype=np.float64)
+        sma[n_days:] = (cumsum[n_days:] - cumsum[:-n_days]) / n_days
+        return sma
+
+
+    def max_since(self, anchor, date):
+        '''
+        Returns the highest value from <anchor> to <date> (inclusive), i.e.
+        max(self[anchor:date]). The running maximum since <anchor> is 
+        calculated once and kept in cache, so every next call is O(1).
+        '''
+        return self._extreme_since(anchor, date, np.maximum)
+
+
+    def min_since(self, anchor, date):
+        '''
+        Returns the lowest value from <anchor> to <date> (inclusive), see 
+        max_since.
+        '''
+        return self._extreme_since(anchor, date, np.minimum)
+
+
+    def _extreme_since(self, anchor, date, ufunc):
+        i_anchor = self.index(anchor)
+        extremes = indicator_cache.get(self, (ufunc.__name__, i_anchor), 
+                lambda: ufunc.accumulate(self.values[i_anchor:]))
+        return extremes.item(max(self.index(date) - i_anchor, 0))
 
 
     def drawdown(self, n_days=None, date=None):
@@ -144,35 +263,32 @@ class StockPrice(DatedList):
 
         If <n_days> is not specified the total time period is considered.
         '''
-#CONSIDER: cleverer algorithm should be faster
-        if n_days is not None:
-            if not isinstance(n_days, int):
-                raise TypeError, 'n_days must be an integer'
-            if n_days < 0:
-                raise ValueError, 'n_days must be > 0'
-        dd_list = []
-        dates = self.dates if date is None else [date]
-        for date in dates:
-            dd_list.append(drawdown(self[date:-n_days]))
+        if n_days is None:
+            n_days = len(self)
+        if not isinstance(n_days, int):
+            raise TypeError, 'n_days must be an integer'
+        if n_days < 1:
+            raise ValueError, 'n_days must be > 0'
+        if date is not None:
+            return drawdown(self[date:-n_days])
+        dd_list = rolling_drawdown(self.values, n_days)
         if len(dd_list) == 1:
-            return dd_list[0]
+            return dd_list.item(0)
         else:
-            return StockPrice(dd_list, self.dates)
+            return StockPrice(dd_list, self.calendar, self.start)
 
 
     def monthly_gains(self):
         '''
         Returns the months gain on the last date of each month.
         '''
-        maxlen = len(self) - 1
-        start_value = self[0]
-        gains = []
-        dates = []
-        for i, (value, date) in enumerate(zip(self, self.dates)):
-            if (i == maxlen) or (i == 0) or (
-                                date.month != self.dates[i+1].month):
-                gains.append(100 * (value / start_value - 1))
-                dates.append(date)
-                start_value = value
-        if len(gains):
-            return StockPrice(gains, dates)
+        unused = self[0] # raises IndexError if the list is empty
+        values = self.values
+        dates = self.dates
+        months = np.array([date.month for date in dates])
+        is_last = np.ones(len(values), dtype=bool)
+        is_last[1:-1] = months[1:-1] != months[2:]
+        indices = np.flatnonzero(is_last)
+        previous = np.concatenate(([0], indices[:-1]))
+        gains = 100 * (values[indices] / values[previous] - 1)
+        return StockPrice(gains, [dates[i] for i in indices])
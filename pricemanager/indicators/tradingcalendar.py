@@ -0,0 +1,159 @@
+'''
+pricemanager/indicators/tradingcalendar.py v0.1 130601
+
+Created on 130601
+
+@author: edwin
+'''
+from __future__ import division
+from __future__ import absolute_import
+
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+
+class TradingCalendar(object):
+    '''
+    A sorted list of (trading) dates that is shared by all series of a stock,
+    or by all stocks that have prices on the same dates as the pool index.
+    A DatedList only stores its values and the index of its first date in the
+    calendar.
+
+    It behaves like a read-only list of dates, the only way to change it is to
+    append (or extend) dates, which must be later than the last date.
+    Dates are looked up through a date->index dict, dates that are not in the
+    calendar are found by bisection.
+    <self.ordinals> is a numpy array with the ordinal of each date, so that
+    calendars can be compared/aligned with integer arithmetic.
+    '''
+
+
+    def __init__(self, dates=None):
+        '''
+        <dates> is a sorted list of dates, it is not copied.
+        '''
+        self._dates = [] if dates is None else dates
+        self._index = {}
+        self._ordinals = np.empty(0, dtype=np.int64)
+
+
+    def __len__(self):
+        return len(self._dates)
+
+
+    def __iter__(self):
+        return iter(self._dates)
+
+
+    def __getitem__(self, key):
+        '''
+        Returns the date at index <key>, or a list of dates if <key> is a slice.
+        '''
+        return self._dates[key]
+
+
+    def __contains__(self, date):
+        return date in self._get_index()
+
+
+    def __eq__(self, other):
+        '''
+        A TradingCalendar is equal to any sequence with the same dates.
+        '''
+        if other is self:
+            return True
+        try:
+            return self._dates == list(other)
+        except TypeError:
+            return False
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __repr__(self):
+        return 'TradingCalendar({!r})'.format(self._dates)
+
+
+    def _get_index(self):
+        '''
+        Returns the dict that maps each date to its index. Dates that were
+        appended since the last call are added first.
+        '''
+        for i in range(len(self._index), len(self._dates)):
+            self._index[self._dates[i]] = i
+        return self._index
+
+
+    def position(self, date):
+        '''
+        Returns the index of <date> or None if <date> is not in the calendar.
+        '''
+        return self._get_index().get(date)
+
+
+    def index(self, date):
+        '''
+        Returns the index of <date>, or of the latest date before <date> if
+        <date> is not in the calendar. If <date> is earlier than the first date
+        the return value is 0.
+        '''
+        index = self._get_index().get(date)
+        if index is None:
+            index = max(bisect_right(self._dates, date) - 1, 0)
+        return index
+
+
+    def append(self, date):
+        self._dates.append(date)
+
+
+    def extend(self, dates):
+        self._dates.extend(dates)
+
+
+    @property
+    def ordinals(self):
+        '''
+        Returns a numpy array with the ordinal (days since 1/1/1) of each date.
+        '''
+        n_ordinals = len(self._ordinals)
+        if n_ordinals != len(self._dates):
+            self._ordinals = np.concatenate((self._ordinals, np.array(
+                    [d.toordinal() for d in self._dates[n_ordinals:]],
+                    dtype=np.int64)))
+        return self._ordinals
+
+
+    def align(self, other):
+        '''
+        Returns an int array with, for each date in the calendar <other>, its
+        index in this calendar, or -1 if it is not in this calendar.
+        '''
+        if other is self:
+            return np.arange(len(self))
+        ordinals = self.ordinals
+        indices = np.searchsorted(ordinals, other.ordinals)
+        indices[indices == len(ordinals)] = 0
+        if len(ordinals):
+            indices[ordinals[indices] != other.ordinals] = -1
+        else:
+            indices[:] = -1
+        return indices
+
+
+    def missing(self, other, startdate=None, enddate=None):
+        '''
+        Returns a list with the dates from <startdate> to <enddate> (inclusive)
+        that are in this calendar, but not in the calendar <other>.
+        '''
+        if other is self:
+            return []
+        i_from = 0 if startdate is None else bisect_left(self._dates, 
+                startdate)
+        i_to = len(self) if enddate is None else bisect_right(self._dates,
+                enddate)
+        missing = ~np.in1d(self.ordinals[i_from:i_to], other.ordinals)
+        return [self._dates[i_from + i] for i in np.flatnonzero(missing)]
@@ -0,0 +1,101 @@
+'''
+pricemanager/management/commands/calculate_channels.py
+
+Copyright (C) 2013 Edwin van Opstal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+'''
+
+from __future__ import division
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand, make_option
+from django.core.exceptions import ObjectDoesNotExist
+
+from pricemanager.models import Pool
+from pyutillib.date_utils import datestr2date
+
+
+class Command(BaseCommand):
+    help = "Calculate the channels of all stocks in a pool in parallel"
+    option_list = BaseCommand.option_list + (
+            make_option('--startdate', '-s',
+                dest='startdate',
+                type = 'str',
+                help='Calculate channels from this date'
+            ),
+            make_option('--enddate', '-e',
+                dest='enddate',
+                type = 'str',
+                help='Calculate channels to this date'
+            ),
+            make_option('--pool', '-p',
+                dest='pool',
+                type='str',
+                help='Name of the pool'
+            ),
+            make_option('--pool_id', '-i',
+                dest='pool_id',
+                type='int',
+                help='id of the pool'
+            ),
+            make_option('--processes', '-n',
+                dest='processes',
+                type='int',
+                help='Number of worker processes (default: number of cores)'
+            ),
+            make_option('--all', '-a',
+                action='store_true',
+                dest='all',
+                default=False,
+                help='Also calculate stocks that already have channels'
+            ),)
+
+    def handle(self, **options):
+        if options.get('pool'):
+            if options.get('pool_id'):
+                print 'Error: pool and pool_id were found, only 1 must be '\
+                        'specified'
+                raise SystemExit
+            try:
+                pool = Pool.objects.get(name=options.get('pool'))
+            except ObjectDoesNotExist:
+                print 'Error: pool {} was not found'.format(options.get('pool'))
+                raise SystemExit
+        elif options.get('pool_id'):
+            try:
+                pool = Pool.objects.get(id=options.get('pool_id'))
+            except ObjectDoesNotExist:
+                print 'Error: pool_id {} was not found'.format(options.get(
+                        'pool_id'))
+                raise SystemExit
+        else:
+            raise SystemExit('Error: A pool or pool_id must be specified')
+        kwargs = {}
+        try:
+            if options.get('startdate'):
+                kwargs['startdate'] = datestr2date(options.get('startdate'))
+            if options.get('enddate'):
+                kwargs['enddate'] = datestr2date(options.get('enddate'))
+        except ValueError, e:
+            raise SystemExit('Error: {}'.format(e))
+        if ('startdate' in kwargs) != ('enddate' in kwargs):
+            raise SystemExit('Error: startdate and enddate must both be '\
+                    'specified or both be omitted')
+        failed = pool.calculate_channels_parallel(
+                processes=options.get('processes'), 
+                resume=not options.get('all'), **kwargs)
+        if failed:
+            raise SystemExit('Error: channels failed for {}'.format(
+                    ', '.join(failed)))
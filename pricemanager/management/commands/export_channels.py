@@ -0,0 +1,49 @@
+'''
+pricemanager/management/commands/export_channels.py
+
+Copyright (C) 2013 Edwin van Opstal
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see `<http://www.gnu.org/licenses/>`.
+'''
+
+from __future__ import division
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand, make_option
+from django.core.exceptions import ObjectDoesNotExist
+
+from pricemanager.models import Stock
+from channel.models import ChannelHistory
+
+
+class Command(BaseCommand):
+    help = "Copy the channels from the Channel table to the compact "\
+            "ChannelHistory table (one row per stock and lookback)"
+    option_list = BaseCommand.option_list + (
+            make_option('--stock', '-s',
+                dest='stock',
+                type='str',
+                help='Name of the stock (default: all stocks)'
+            ),)
+
+    def handle(self, **options):
+        stocks = None
+        if options.get('stock'):
+            try:
+                stocks = [Stock.objects.get(name=options.get('stock'))]
+            except ObjectDoesNotExist:
+                raise SystemExit('Error: stock {} was not found'.format(
+                        options.get('stock')))
+        n_histories = ChannelHistory.export_table(stocks)
+        print 'Exported {} channel histories'.format(n_histories)
@@ -22,13 +22,18 @@ from __future__ import division
 from __future__ import absolute_import
 
 import datetime, time
+import multiprocessing
 from operator import itemgetter
+from itertools import groupby
+from bisect import bisect_right
 from collections import defaultdict
 
+import numpy as np
+
 from django import db
 from django.db import models, transaction
 
-from TSB.utils import notify_admin
+from TSB.utils import notify_admin, bulk_insert
 from pyutillib.date_utils import previous_weekday, last_year, datestr2date
 from pyutillib.string_utils import random_string
         
@@ -36,7 +41,8 @@ from chart.models import Chart
 from channel.models import Channel
 
 from pricemanager.indicators.multi import StockPrices
-from pricemanager.indicators.single import StockPrice
+from pricemanager.indicators.cache import indicator_cache, indicator_store
+from pricemanager.indicators.panel import PricePanel
 from pricemanager.yahoo import download_today, download_history
 #from pricemanager.download import download_today, download_history
 
@@ -149,15 +155,9 @@ class Stock(models.Model):
         if not hasattr(self, '_price'):
             startdate, enddate = self.price_date_range
             self._price = StockPrices(self)
-            qs = Price.objects.filter(stock=self, date__gte=startdate, 
-                    date__lte=enddate).order_by('date')
-            dates = [s.date for s in qs]
-            for column in ['open', 'high', 'low', 'close', 'volume']:
-                if column == 'volume':
-                    data = [getattr(s, column) for s in qs]
-                else:
-                    data = [float(getattr(s, column)) for s in qs]
-                setattr(self._price, column, StockPrice(data, dates))
+            self._price.load(Price.objects.filter(stock=self, 
+                    date__gte=startdate, date__lte=enddate).order_by('date'
+                    ).values_list(*Price.COLUMNS))
         return self._price
 
 
@@ -235,8 +235,8 @@ class Stock(models.Model):
                 raise ValueError('currency {} not implemented yet'.format(
                         self.currency))
             index = Stock.objects.get(name=index_name)
-        return [d for d in index.price.close.get_dates(startdate, enddate)
-                if d not in self.price.close.dates]
+        return index.price.calendar.missing(self.price.calendar, startdate,
+                enddate)
 
 
     def missing_channels(self, startdate=None, enddate=None):
@@ -249,8 +249,7 @@ class Stock(models.Model):
         startdate = self.get_earliest_date() + datetime.timedelta(days=365)
         enddate = self.get_latest_date()
         if startdate < enddate:
-            channeldates = Channel.objects.values_list(
-                    'date', flat=True).filter(stock=self)
+            channeldates = Channel.stored_dates(self)
             return [d for d in self.price.close.get_dates(startdate, enddate)
                     if d not in channeldates]
 
@@ -258,6 +257,7 @@ class Stock(models.Model):
     def correct_splits(self):
         '''
         Adjust prices to remove the effect of stock splits
+        Stored indicators of this stock are removed.
         '''
         startdate = self.get_earliest_date()
         for enddate, ratio, price in self.check_splits():
@@ -272,6 +272,7 @@ class Stock(models.Model):
                     price.low *= ratio
                     price.volume /= ratio
                     price.save()
+        indicator_store.invalidate([self.id])
 
 
     def check_splits(self):
@@ -309,8 +310,7 @@ class Stock(models.Model):
         sl_c = 100 * (1 - sl / close)
         sl_h = 100 * (1 - sl / high)
 
-        channels = Channel.with_close.filter(stock=self, date=date).order_by(
-                'lookback')
+        channels = Channel.on_date([self], date)
 
         return {'date': date, 'close': close, 'open': self.price.open[date],
                 'high': high, 'low': self.price.low[date],
@@ -354,6 +354,8 @@ class Price(models.Model):
     low = models.DecimalField(max_digits=6, decimal_places=2)
     volume = models.BigIntegerField()
 
+    COLUMNS = ('date', 'open', 'high', 'low', 'close', 'volume')
+
     retry = {} # class variable that keeps track of download retries
 
 
@@ -371,13 +373,14 @@ class Price(models.Model):
         Insert multiple prices into the price table.
 
         <data> is a list of dicts with a key for each <Price> field.
-        If a price record already exists the value will silently be 
-        overwritten.
+        If a price record already exists it is silently skipped.
+        Stored indicators of the stocks in <data> are removed.
+
+        Returns a tuple (n_inserted, n_skipped)
         '''
-        with transaction.commit_on_success():
-            for row in data:
-                cls.objects.get_or_create(stock=row.pop('stock'), 
-                date=row.pop('date'), defaults=row)
+        result = bulk_insert(cls, data, ('stock', 'date'))
+        indicator_store.invalidate(set(d['stock'].id for d in data))
+        return result
 
 
     @classmethod
@@ -466,7 +469,7 @@ class Price(models.Model):
 
         downloaded_data = [d for d in data if len(d) == 7]
         downloaded_stocks = [d['stock'] for d in downloaded_data]
-        cls.insert_prices(downloaded_data) # destroys downloaded_data!
+        cls.insert_prices(downloaded_data)
         split_stocks = cls.check_split(downloaded_stocks)
 
         if split_stocks:
@@ -520,6 +523,8 @@ class Pool(models.Model):
     enddate = models.DateField(null=True, blank=True)
     members = models.ManyToManyField(Stock, through='StockPoolDates')
 
+    PRELOAD_CHUNK = 200 # max number of stocks per query in preload_prices
+
 
 #    @property
 #    def market_type(self):
@@ -626,23 +631,130 @@ class Pool(models.Model):
         <self._cache> is a list of tuples of the format (stock, startdate, 
         enddate) for all stocks in pool. Multiple entries may exist with 
         different date ranges. The index is *not* in the list.
+
+        The membership is also precomputed as an interval index: the list of
+        stocks in <self._cache_members[i]> are the members from 
+        <self._cache_dates[i]> until (excluding) <self._cache_dates[i + 1]>.
         '''
         self._cache = self._get_list()[1:]
+        boundaries = set()
+        for unused, startdate, enddate in self._cache:
+            boundaries.add(startdate)
+            if enddate:
+                boundaries.add(enddate + datetime.timedelta(days=1))
+        self._cache_dates = sorted(boundaries)
+#FIXME: pool=S&P500, startdate=1/12/2012 -> CBE is not filtered out!!!!!
+        self._cache_members = [[stock for stock, startdate, enddate in 
+                self._cache if date >= startdate and (not enddate or 
+                date <= enddate)] for date in self._cache_dates]
 
 
     def get_cached_stocklist(self, date):
         '''
         Returns the list of stocks that were in the pool on <date>.
         '''
-        stock_list = []
         if not self.enddate or self.startdate <= date <= self.enddate:
             if getattr(self, '_cache', None) is None:
                 self._set_cache()
-            for stock, startdate, enddate in self._cache:
-#FIXME: pool=S&P500, startdate=1/12/2012 -> CBE is not filtered out!!!!!
-                if date >= startdate and (not enddate or date <= enddate):
-                    stock_list.append(stock)
-        return stock_list
+            i_interval = bisect_right(self._cache_dates, date) - 1
+            if i_interval >= 0:
+                return list(self._cache_members[i_interval])
+        return []
+
+
+    @property
+    def membership_mask(self):
+        '''
+        Returns a boolean numpy array with a row for each date of the pool 
+        calendar and a column for each stock in self.panel.stocks that is True
+        if the stock is a member of the pool on that date.
+        '''
+        return self.panel.mask
+
+
+    @property
+    def calendar(self):
+        '''
+        Returns the TradingCalendar of the pool index, stocks that have prices
+        on the same dates share this calendar (see preload_prices).
+        '''
+        return self.index.price.calendar
+
+
+    @property
+    def panel(self):
+        '''
+        Returns a PricePanel with the data of all members of the pool on the
+        dates of the pool calendar, it is created on first use.
+        '''
+        if getattr(self, '_panel', None) is None:
+            if getattr(self, '_cache', None) is None:
+                self._set_cache()
+            self._panel = PricePanel(self.calendar, self._cache)
+        return self._panel
+
+
+    @property
+    def cache_token(self):
+        '''
+        Returns the token that identifies the pool, its members and the dates 
+        of its calendar in the indicator cache, so that pool indicators (e.g.
+        market_breadth) are shared by all instances of the pool.
+        '''
+        if getattr(self, '_cache', None) is None:
+            self._set_cache()
+        calendar = self.calendar
+        return ('pool', self.id, tuple((stock.id, startdate, enddate) for 
+                stock, startdate, enddate in self._cache), len(calendar), 
+                calendar[0] if len(calendar) else None, 
+                calendar[-1] if len(calendar) else None)
+
+
+    def market_breadth(self, lookback):
+        '''
+        Returns a DatedList with, for each date of the pool calendar, the 
+        fraction of the pool members with a positive <lookback> channel angle
+        (0 on dates without members).
+        The result is kept in the indicator cache.
+        '''
+        return indicator_cache.get(self, ('breadth', lookback), lambda: 
+                self.panel.fraction(self.panel.channel('angle', lookback) > 0))
+
+
+    def preload_prices(self, startdate, enddate):
+        '''
+        Loads the prices from <startdate> to <enddate> of all stocks in the 
+        pool, including the index, with one query per PRELOAD_CHUNK stocks 
+        instead of one query per stock.
+        The prices are attached to the cached stock instances, i.e. the ones
+        that are returned by get_cached_stocklist. Stocks that already have
+        prices in memory are skipped.
+        '''
+        if getattr(self, '_cache', None) is None:
+            self._set_cache()
+        stocks = defaultdict(list)
+        for stock in [self.index] + [s for s, unused, unused in self._cache]:
+            # model instances compare equal by id, so check identity instead:
+            if not hasattr(stock, '_price') and not any(s is stock for s in
+                    stocks[stock.id]):
+                stocks[stock.id].append(stock)
+        # the index goes first, so that stocks can share its calendar:
+        stock_ids = sorted(stocks.keys(), key=lambda i: (i != self.index.id, 
+                i))
+        calendar = self.calendar if hasattr(self.index, '_price') else None
+        for i in range(0, len(stock_ids), self.PRELOAD_CHUNK):
+            chunk = stock_ids[i:i + self.PRELOAD_CHUNK]
+            rows = Price.objects.filter(stock__in=chunk, date__gte=startdate,
+                    date__lte=enddate).order_by('stock', 'date').values_list(
+                    'stock', *Price.COLUMNS)
+            loaded = dict((stock_id, [row[1:] for row in stock_rows]) for 
+                    stock_id, stock_rows in groupby(rows, itemgetter(0)))
+            for stock_id in chunk:
+                for stock in stocks[stock_id]:
+                    stock._price = StockPrices(stock)
+                    stock._price.load(loaded.get(stock_id, []), calendar)
+                    if stock_id == self.index.id:
+                        calendar = stock._price.calendar
 
 
     def size(self):
@@ -811,6 +923,58 @@ class Pool(models.Model):
             Channel.calculate(stock, startdate, enddate)
 
 
+    def calculate_channels_parallel(self, startdate=None, enddate=None, 
+            processes=None, resume=True):
+        '''
+        Calculate channel data for all stocks in the pool with <processes> 
+        worker processes (default: one per cpu core). The workers only
+        calculate the channels, this process writes them to the database.
+        If <resume> is True, stocks that already have channels up to <enddate>
+        (or up to their latest price) are skipped, so an interrupted job can 
+        simply be restarted.
+        Returns a list with the names of the stocks that failed.
+        '''
+        stocks = {}
+        for stock, unused, unused in self._get_list():
+            stocks.setdefault(stock.id, stock)
+        if resume:
+            for stock_id, stock in stocks.items():
+                channel_enddate = Channel.get_enddate(stock)
+                if channel_enddate and channel_enddate >= (enddate or 
+                        Price.get_enddate(stock)):
+                    del stocks[stock_id]
+        n_stocks = len(stocks)
+        print 'Calculating channels for {} stocks'.format(n_stocks)
+        failed = []
+        if not stocks:
+            return failed
+        db.close_connection() # the workers must not share the connection
+        workers = multiprocessing.Pool(processes)
+        jobs = [(stock_id, startdate, enddate) for stock_id in stocks]
+        starttime = time.time()
+        try:
+            for i_stock, (stock_id, result) in enumerate(workers.imap_unordered(
+                    _calculate_stock_channels, jobs), 1):
+                stock = stocks[stock_id]
+                if isinstance(result, basestring):
+                    failed.append(stock.name)
+                    print '{}/{} {} FAILED: {}'.format(i_stock, n_stocks,
+                            stock.name, result)
+                    continue
+                lookbacks, ordinals, channels, startdates = result
+                dates = [datetime.date.fromordinal(o) for o in ordinals.tolist()]
+                n_inserted, n_skipped = Channel.save_array(stock, lookbacks,
+                        dates, channels, startdates)
+                dt = time.time() - starttime
+                print '{}/{} {}: written {}, skipped {} existing ({:1.0f}:'\
+                        '{:02.0f})'.format(i_stock, n_stocks, stock.name, 
+                        n_inserted, n_skipped, dt // 60, dt % 60)
+        finally:
+            workers.close()
+            workers.join()
+        return failed
+
+
 #    @staticmethod
 #    def _check_prices(stock_list, startdate=None, enddate=None):
 #        '''
@@ -987,6 +1151,23 @@ class Pool(models.Model):
         return '{}'.format(self.name)
 
 
+def _calculate_stock_channels((stock_id, startdate, enddate)):
+    '''
+    Worker function for Pool.calculate_channels_parallel.
+    Returns a tuple (stock_id, result), where <result> is a tuple (lookbacks, 
+    date ordinals, channels, startdates), see Channel.calculate_array, or the
+    error message if the calculation failed.
+    '''
+    try:
+        stock = Stock.objects.get(id=stock_id)
+        lookbacks, dates, channels, startdates = Channel.calculate_array(stock,
+                startdate, enddate)
+    except Exception, e:
+        return stock_id, '{}: {}'.format(type(e).__name__, e)
+    ordinals = np.array([d.toordinal() for d in dates], dtype=np.int32)
+    return stock_id, (lookbacks, ordinals, channels, startdates)
+
+
 class StockPoolDates(models.Model):
     '''
     Provides extra dates fields on the Pool-Stocks manytomany relationship.
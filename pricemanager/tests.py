@@ -1,17 +1,30 @@
 from __future__ import division
 from __future__ import absolute_import
 
+import os, shutil, tempfile
 from datetime import date, timedelta
 from copy import deepcopy
+from random import Random
+
+import numpy as np
 
 from django.test import TestCase
 
 from pyutillib.date_utils import last_year, previous_weekday, next_weekday
 
-from pricemanager.models import Stock, Price, Pool, StockPoolDates
+from pricemanager.models import Stock, Price, Pool, StockPoolDates,\
+        _calculate_stock_channels
 from pricemanager.yahoo import _yahoo_today_url, _yahoo_history_url, _unsplit,\
         download_today, download_history
-from pricemanager.indicators.datedlist import DatedList
+from pricemanager.indicators.datedlist import DatedList, DatedListView
+from pricemanager.indicators.single import calc_ema, drawdown, rolling_max,\
+        rolling_min, StockPrice
+from pricemanager.indicators.multi import StockPrices
+from pricemanager.indicators.tradingcalendar import TradingCalendar
+from channel.models import Channel
+from metasystem.parameters.params_rank import rank_roc
+from pricemanager.indicators.cache import IndicatorCache, IndicatorStore,\
+        indicator_cache
 
 
 class DatedListTests(TestCase):
@@ -88,6 +101,317 @@ class DatedListTests(TestCase):
         self.assertRaises(TypeError, dl[1:2])
         with self.assertRaises(TypeError):
             dl[1:date(2012,1,4)]
+    # replace dates
+        dl.dates = [date(2012,2,x) for x in range(1,9)]
+        self.assertEqual(dl[date(2012,2,3)], 4)
+        self.assertEqual(dl.index(date(2012,2,12)), 7)
+        self.assertIsNone(dl.on(date(2012,1,3)))
+        self.assertEqual(dl.get_dates(date(2012,1,20), date(2012,2,2)), 
+                [date(2012,2,1), date(2012,2,2)])
+
+
+    def test_views(self):
+        dates = [date(2012,1,x) for x in range(2,10)]
+        dl = DatedList([float(x) for x in range(2,10)], dates)
+        view = dl[date(2012,1,3):date(2012,1,5)]
+        self.assertIsInstance(view, DatedListView)
+        self.assertEqual(view, [3,4,5])
+        self.assertEqual(view.dates, dates[1:4])
+        self.assertEqual(view[date(2012,1,4)], 4)
+        self.assertTrue(np.may_share_memory(view.values, dl.values))
+        self.assertEqual(view[1:], [4,5])
+        self.assertEqual(dl[::2].dates, dates[::2])
+    # a view can be extended without changing its parent
+        view.append((date(2012,1,20), 20.))
+        self.assertEqual(view, [3,4,5,20])
+        self.assertEqual(dl, range(2,10))
+        self.assertEqual(len(dl.dates), 8)
+    # copy
+        copy = dl[date(2012,1,4):-2].copy()
+        self.assertEqual(copy, [3,4])
+        self.assertFalse(np.may_share_memory(copy.values, dl.values))
+
+
+
+class TradingCalendarTests(TestCase):
+
+    def test_calendar(self):
+        dates = [date(2012,1,x) for x in (2,3,4,5,6,9,10)]
+        calendar = TradingCalendar(dates)
+        self.assertEqual(calendar, dates)
+        self.assertEqual(calendar.index(date(2012,1,8)), 4)
+        self.assertEqual(calendar.index(date(2012,1,1)), 0)
+        self.assertIsNone(calendar.position(date(2012,1,8)))
+        self.assertEqual(list(calendar.ordinals), 
+                [d.toordinal() for d in dates])
+        other = TradingCalendar([date(2012,1,x) for x in (3,4,6,9,11)])
+        self.assertEqual(list(calendar.align(other)), [1,2,4,5,-1])
+        self.assertEqual(calendar.missing(other), 
+                [date(2012,1,2), date(2012,1,5), date(2012,1,10)])
+        self.assertEqual(calendar.missing(other, date(2012,1,4), 
+                date(2012,1,9)), [date(2012,1,5)])
+        self.assertEqual(calendar.missing(calendar), [])
+
+    def test_shared_calendar(self):
+        dates = [date(2012,1,x) for x in (2,3,4,5,6,9,10)]
+        calendar = TradingCalendar(dates)
+        full = DatedList(range(7), calendar)
+        self.assertIs(full.dates, calendar)
+        tail = DatedList([1.,2.], calendar, 5)
+        self.assertEqual(tail.dates, dates[5:])
+        self.assertEqual(tail[date(2012,1,7)], 1.)
+        self.assertEqual(tail[date(2012,1,1)], 1.)
+        self.assertEqual(tail[date(2012,1,20)], 2.)
+        self.assertIsNone(tail.on(date(2012,1,5)))
+        self.assertFalse(date(2012,1,5) in tail)
+        self.assertEqual(tail.get_date(date(2012,1,1), 5), date(2012,1,10))
+        with self.assertRaises(ValueError):
+            DatedList([1.,2.], calendar, 6)
+    # appending to the last list extends the calendar
+        tail.append((date(2012,1,11), 3.))
+        self.assertIs(tail.calendar, calendar)
+        self.assertEqual(len(calendar), 8)
+        self.assertEqual(len(full.dates), 7)
+    # appending other dates gives the list its own calendar
+        other = DatedList([5.], calendar, 6)
+        other.append((date(2012,1,12), 6.))
+        self.assertIsNot(other.calendar, calendar)
+        self.assertEqual(other.dates, [date(2012,1,10), date(2012,1,12)])
+        self.assertEqual(len(calendar), 8)
+    # views share the calendar
+        view = full[date(2012,1,4):date(2012,1,9)]
+        self.assertIs(view.calendar, calendar)
+        self.assertEqual(view.dates, dates[2:6])
+        self.assertEqual(view.index(date(2012,1,7)), 2)
+
+
+
+class StockPricesTests(TestCase):
+
+    def test_load(self):
+        rows = [(date(2012,1,x), x + 0.5, x + 1., x - 1., x + 0.25, 100 * x)
+                for x in range(2,6)]
+        prices = StockPrices(None)
+        prices.load(rows)
+        self.assertEqual(prices.close.dates, [r[0] for r in rows])
+        self.assertEqual(prices.open, [r[1] for r in rows])
+        self.assertEqual(prices.high, [r[2] for r in rows])
+        self.assertEqual(prices.low, [r[3] for r in rows])
+        self.assertEqual(prices.close, [r[4] for r in rows])
+        self.assertEqual(prices.volume, [r[5] for r in rows])
+        self.assertEqual(prices.close[date(2012,1,3)], 3.25)
+        self.assertEqual(prices.close.values.dtype, 'float64')
+        self.assertEqual(prices.volume.values.dtype, 'int64')
+        # the price lists are views onto a single array:
+        self.assertIs(prices.open.values.base, prices.close.values.base)
+        prices.load([])
+        self.assertEqual(len(prices.close), 0)
+
+
+
+class IndicatorTests(TestCase):
+    '''
+    Regression tests: the (vectorised) indicators must give the same results as
+    the straightforward loops below.
+    '''
+
+    def setUp(self):
+        rng = Random(1)
+        rows = []
+        day = date(2011,1,3)
+        close = 20.
+        while len(rows) < 300:
+            if day.weekday() < 5:
+                close *= 1 + rng.gauss(0, 0.02)
+                high = close * (1 + rng.random() * 0.02)
+                low = close * (1 - rng.random() * 0.02)
+                rows.append((day, (high + low) / 2, high, low, close, 
+                        rng.randint(1000, 2000)))
+            day += timedelta(days=1)
+        self.prices = StockPrices(None)
+        self.prices.load(rows)
+        self.close = self.prices.close.as_list()
+        self.high = self.prices.high.as_list()
+        self.low = self.prices.low.as_list()
+
+    def assertListAlmostEqual(self, list1, list2):
+        self.assertEqual(len(list1), len(list2))
+        for value1, value2 in zip(list1, list2):
+            self.assertAlmostEqual(value1, value2, places=9)
+
+    def test_single(self):
+        close = self.close
+        n = len(close)
+        for n_days in (1, 10, 252, 400):
+            self.assertListAlmostEqual(self.prices.close.roc(n_days), 
+                    [100 * (close[i] / close[max(i - n_days, 0)] - 1) 
+                    for i in range(n)])
+            ma_sum = sum(close[:n_days])
+            sma = [ma_sum / n_days] * min(n_days, n)
+            for i in range(n_days, n):
+                ma_sum = ma_sum + close[i] - close[i - n_days]
+                sma.append(ma_sum / n_days)
+            self.assertListAlmostEqual(self.prices.close.sma(n_days), sma)
+            new_mpl = 2 / (n_days + 1)
+            avg = sum(close[:n_days]) / len(close[:n_days])
+            ema = []
+            for value in close:
+                avg = (1 - new_mpl) * avg + new_mpl * value
+                ema.append(avg)
+            self.assertListAlmostEqual(self.prices.close.ema(n_days), ema)
+            self.assertListAlmostEqual(calc_ema(close, n_days), ema)
+            self.assertListAlmostEqual(self.prices.close.drawdown(n_days), 
+                    [drawdown(close[max(i - n_days + 1, 0):i + 1]) 
+                    for i in range(n)])
+        self.assertEqual(self.prices.close.drawdown(20, date(2011,6,1)),
+                self.prices.close.drawdown(20)[date(2011,6,1)])
+        gains = []
+        start_value = close[0]
+        dates = self.prices.close.dates
+        for i, value in enumerate(close):
+            if i in (0, n - 1) or dates[i].month != dates[i + 1].month:
+                gains.append(100 * (value / start_value - 1))
+                start_value = value
+        self.assertListAlmostEqual(self.prices.close.monthly_gains(), gains)
+
+    def test_multi(self):
+        close, high, low = self.close, self.high, self.low
+        n = len(close)
+        for n_days in (1, 10, 252):
+            wr = []
+            for i in range(n):
+                i_from = max(i - n_days + 1, 0)
+                high_n = max(high[i_from:i + 1])
+                low_n = min(low[i_from:i + 1])
+                wr.append(-100 * (high_n - close[i]) / (high_n - low_n))
+            self.assertListAlmostEqual(self.prices.wr(n_days), wr)
+            self.assertEqual(self.prices.wr(n_days, date(2011,6,1)), 
+                    self.prices.wr(n_days)[date(2011,6,1)])
+            for as_price in (True, False):
+                tr = []
+                for i in range(n):
+                    yest_close = close[max(i - 1, 0)]
+                    day_range = max(yest_close, high[i]) - min(yest_close, 
+                            low[i])
+                    tr.append(day_range if as_price else day_range/close[i])
+                self.assertListAlmostEqual(self.prices.atr(n_days, 
+                        as_price=as_price), calc_ema(tr, n_days))
+        atr = self.prices.atr(10).as_list()
+        dma = []
+        for i_start in range(n):
+            startprice = close[i_start]
+            i = 0
+            for j in range(i_start, -1, -1):
+                range_ = 0.5 * atr[j]
+                if low[j] <= startprice - range_:
+                    factor = (startprice - low[j]) // range_
+                    startprice -= factor * range_
+                    i += factor
+                elif high[j] > startprice + range_:
+                    factor = (high[j] - startprice) // range_
+                    startprice += factor * range_
+                    i += factor
+                if i >= 5:
+                    break
+            dma.append(sum(close[j:i_start + 1]) / (i_start + 1 - j))
+        self.assertListAlmostEqual(self.prices.dma(5), dma)
+
+    def test_rolling(self):
+        high = self.high
+        n = len(high)
+        for n_days in (1, 2, 7, 252, 400):
+            max_list = [max(high[max(i - n_days + 1, 0):i + 1]) 
+                    for i in range(n)]
+            min_list = [min(high[max(i - n_days + 1, 0):i + 1]) 
+                    for i in range(n)]
+            self.assertEqual(list(rolling_max(self.prices.high.values, 
+                    n_days)), max_list)
+            self.assertEqual(list(rolling_min(self.prices.high.values, 
+                    n_days)), min_list)
+        dates = self.prices.high.dates
+        for i_anchor in (0, 50, 299):
+            for i_date in range(i_anchor, n, 10):
+                self.assertEqual(self.prices.high.max_since(dates[i_anchor], 
+                        dates[i_date]), max(high[i_anchor:i_date + 1]))
+                self.assertEqual(self.prices.high.min_since(dates[i_anchor], 
+                        dates[i_date]), min(high[i_anchor:i_date + 1]))
+
+
+
+class IndicatorCacheTests(TestCase):
+
+    def setUp(self):
+        dates = [date(2013, 1, 1) + timedelta(i) for i in range(100)]
+        self.prices = [StockPrice([float(i + j) for i in range(100)], dates) 
+                for j in range(3)]
+
+    def test_get(self):
+        cache = IndicatorCache(max_bytes=2000) # room for 2 arrays of 800 bytes
+        calls = []
+        def calculate(x):
+            calls.append(x)
+            return x.values * 2
+        for x in self.prices:
+            self.assertEqual(list(cache.get(x, ('X2',), lambda: calculate(x))),
+                    [2 * v for v in x.values])
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.n_bytes, 1600)
+        # prices[0] was evicted, prices[2] is still cached
+        cache.get(self.prices[2], ('X2',), lambda: calculate(self.prices[2]))
+        self.assertEqual(len(calls), 3)
+        cache.get(self.prices[0], ('X2',), lambda: calculate(self.prices[0]))
+        self.assertEqual(len(calls), 4)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                (1, 4, 2))
+        self.assertEqual(stats['hit_rate'], 0.2)
+        # a value that is larger than the cache is not stored
+        cache.get(self.prices[1], ('BIG',), lambda: np.zeros(1000))
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual((len(cache), cache.n_bytes, cache.hits), (0, 0, 0))
+
+    def test_version(self):
+        x = self.prices[0]
+        token = x.cache_token
+        self.assertEqual(x.cache_token, token)
+        self.assertNotEqual(self.prices[1].cache_token, token)
+        sma = x.sma(5)
+        self.assertIs(x.sma(5), sma)
+        x.append((date(2013, 4, 11), 100.))
+        self.assertNotEqual(x.cache_token, token)
+        self.assertEqual(len(x.sma(5)), 101)
+        hits = indicator_cache.hits
+        x.ema(5, cache=False)
+        self.assertEqual(indicator_cache.hits, hits)
+
+    def test_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = IndicatorStore(directory)
+            x = self.prices[0]
+            calls = []
+            def calculate():
+                calls.append(1)
+                return x.values * 2
+            store.get(x, ('X2',), calculate) # x has no store key
+            self.assertEqual(os.listdir(directory), [])
+            x.store_key = (7, 'close', 'abc')
+            self.assertEqual(x.store_key, (7, 'close', 'abc'))
+            for unused in range(2):
+                self.assertEqual(list(store.get(x, ('X2',), calculate)),
+                        [2 * v for v in x.values])
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(os.listdir(os.path.join(directory, '7')), 
+                    ['close.X2.abc.npy'])
+            store.invalidate([7])
+            self.assertFalse(os.path.exists(os.path.join(directory, '7')))
+            x.append((date(2013, 4, 11), 100.))
+            self.assertIsNone(x.store_key)
+            self.assertFalse(IndicatorStore().enabled)
+        finally:
+            shutil.rmtree(directory)
 
 
 
@@ -211,6 +535,42 @@ class modelsTestsFixture(TestCase):
         self.assertEqual(aapl.price.close[testdate], 577.73)
         self.assertEqual(aapl.price.volume[testdate], 17559800)
 
+    def test_calculate_stock_channels(self):
+        aapl = Stock.objects.get(name='AAPL')
+        startdate, enddate = date(2012,5,1), date(2012,6,30)
+        stock_id, (lookbacks, ordinals, channels, startdates) = \
+                _calculate_stock_channels((aapl.id, startdate, enddate))
+        self.assertEqual(stock_id, aapl.id)
+        self.assertIsNone(startdates)
+        aapl = Stock.objects.get(name='AAPL')
+        result = Channel.calculate_array(aapl, startdate, enddate)
+        self.assertEqual(lookbacks, result[0])
+        self.assertEqual([date.fromordinal(o) for o in ordinals], result[1])
+        self.assertTrue((channels == result[2]).all())
+        self.assertIsInstance(_calculate_stock_channels((-1, None, None))[1],
+                basestring)
+
+    def test_Pool_market_breadth(self):
+        aapl = Stock.objects.get(name='AAPL')
+        intc = Stock.objects.get(name='INTC')
+        pool = Pool.objects.create(name='test', description='test', index=intc,
+                startdate=date(2012,5,1), enddate=date(2012,6,29))
+        StockPoolDates.objects.create(stock=aapl, pool=pool)
+        StockPoolDates.objects.create(stock=intc, pool=pool, 
+                startdate=date(2012,6,1))
+        for stock in pool.get_cached_stocklist(date(2012,6,1)):
+            stock.date_range = (date(2012,5,1), date(2012,6,29))
+        pool.preload_prices(date(2011,4,1), date(2012,6,29))
+        breadth = pool.market_breadth(Channel.MONTH)
+        self.assertEqual(breadth.dates, pool.calendar)
+        for day in breadth.dates:
+            stocks = pool.get_cached_stocklist(day)
+            n_pos = sum(1 for s in stocks if 
+                    s.price.channel.angle(Channel.MONTH)[day] > 0)
+            self.assertEqual(breadth[day], n_pos / len(stocks) if stocks 
+                    else 0)
+        self.assertIs(pool.market_breadth(Channel.MONTH), breadth)
+
 
 class modelsTests(TestCase):
 
@@ -258,10 +618,17 @@ class modelsTests(TestCase):
             data.append({'stock': stock, 'date': date(2010,1,x),
                     'open': 1., 'high': 1., 'low': 1., 'close': 1., 
                     'volume': x })
-        Price.insert_prices(data)
+        self.assertEqual(Price.insert_prices(data), (4, 0))
         self.assertEqual(Price.objects.all().count(), 8)
-        Price.insert_prices([])
+        self.assertEqual(Price.insert_prices([]), (0, 0))
         self.assertEqual(Price.objects.all().count(), 8)
+        data.append(dict(data[-1]))
+        data.append({'stock': stock, 'date': date(2010,1,16), 'open': 1., 
+                'high': 1., 'low': 1., 'close': 1., 'volume': 16 })
+        self.assertEqual(Price.insert_prices(data), (1, 5))
+        self.assertEqual(Price.objects.all().count(), 9)
+        self.assertEqual(Price.objects.get(stock=stock, 
+                date=date(2010,1,14)).volume, 14)
 
     # check_split
 
@@ -326,6 +693,76 @@ class modelsTests(TestCase):
         self.assertIsNotNone(intc.has_prices(date3, date5))
 
 
+    def test_Pool_preload_prices(self):
+        date1 = date(2010,1,4)
+        date2 = date(2010,1,8)
+        aapl = Stock.objects.get(name='AAPL')
+        intc = Stock.objects.get(name='INTC')
+        fdx = Stock.objects.get(name='FDX')
+        pool = Pool.objects.create(name='test', description='test', index=intc,
+                startdate=date1, enddate=date2)
+        StockPoolDates.objects.create(stock=aapl, pool=pool)
+        StockPoolDates.objects.create(stock=fdx, pool=pool)
+        for x, stock in enumerate((aapl, intc)):
+            for day in range(4, 9):
+                Price.objects.create(stock=stock, date=date(2010,1,day), 
+                        open=1., high=2., low=0.5, close=day + x, volume=day)
+        pool.preload_prices(date(2010,1,5), date2)
+        stocks = pool.get_cached_stocklist(date1)
+        self.assertEqual(len(stocks), 2)
+        for stock in stocks:
+            self.assertTrue(hasattr(stock, '_price'))
+            if stock.name == 'AAPL':
+                self.assertEqual(stock.price.close, [5., 6., 7., 8.])
+                self.assertIs(stock.price.calendar, pool.calendar)
+            else:
+                self.assertEqual(len(stock.price.close), 0)
+        self.assertEqual(pool.index.price.close, [6., 7., 8., 9.])
+        self.assertEqual(pool.index.price.volume.dates, 
+                [date(2010,1,x) for x in range(5, 9)])
+
+
+    def test_Pool_panel(self):
+        aapl = Stock.objects.get(name='AAPL')
+        intc = Stock.objects.get(name='INTC')
+        fdx = Stock.objects.get(name='FDX')
+        pool = Pool.objects.create(name='test', description='test', index=intc,
+                startdate=date(2010,1,4), enddate=date(2010,1,8))
+        StockPoolDates.objects.create(stock=aapl, pool=pool)
+        StockPoolDates.objects.create(stock=fdx, pool=pool, 
+                startdate=date(2010,1,6))
+        for stock, days in ((intc, (4,5,6,7,8)), (aapl, (4,5,6,7,8)), 
+                (fdx, (5,7))):
+            for day in days:
+                Price.objects.create(stock=stock, date=date(2010,1,day), 
+                        open=1., high=2., low=0.5, close=day, volume=day)
+        pool.preload_prices(date(2010,1,4), date(2010,1,8))
+        panel = pool.panel
+        self.assertEqual(panel.stocks, [aapl, fdx])
+        self.assertEqual(panel.close.shape, (5, 2))
+        self.assertEqual(list(panel.close[:, 0]), [4., 5., 6., 7., 8.])
+        # missing prices are the latest price before the date
+        self.assertEqual(list(panel.close[:, 1]), [5., 5., 5., 7., 7.])
+        self.assertEqual(panel.members(date(2010,1,5)), [aapl])
+        self.assertEqual(panel.members(date(2010,1,6)), [aapl, fdx])
+        self.assertEqual(list(panel.roc(1, date(2010,1,5))), [25., 0.])
+        # stock_roc offsets on the dates of the stock (fdx: 5 -> 7)
+        self.assertEqual(list(panel.stock_roc(1)[panel.row(date(2010,1,8))]),
+                [aapl.price.close.roc(1, date(2010,1,8)), 40.])
+        rank = rank_roc(par_type='rank', rule='test', nd=1, op='gt', th=20.)
+        ranked = rank.get_list([aapl, fdx], date(2010,1,8), pool=pool)
+        self.assertEqual([(s, v) for s, v, unused in ranked], [(s, v) for s,
+                v, unused in rank.get_list([aapl, fdx], date(2010,1,8))])
+        self.assertEqual([(s, valid) for s, unused, valid in ranked], 
+                [(fdx, True), (aapl, False)])
+        self.assertEqual(panel.fraction(panel.close > 7).as_list(), 
+                [0., 0., 0., 0., 0.5])
+        self.assertIs(pool.membership_mask, panel.mask)
+        for day in range(4, 9):
+            self.assertEqual(pool.get_cached_stocklist(date(2010,1,day)), 
+                    panel.members(date(2010,1,day)))
+
+
     def test_Pool(self):
         date1 = date(2000,1,1)
         date2 = date(2010,1,5)
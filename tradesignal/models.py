@@ -9,6 +9,8 @@ Created on 20120907
 from __future__ import division
 from __future__ import absolute_import
 
+from collections import OrderedDict, defaultdict
+
 from django.db import models, transaction
 
 from pyutillib.math_utils import div
@@ -205,8 +207,17 @@ class Positions(object):
     '''
     This class maintains the positions of positions.
 
-    The positions is a list of positions. Each position is an executed entry
-    signal, where the entry signal is an instance of the EntrySignal class.
+    The positions are kept in a dict keyed by (stock, method), model instances
+    hash and compare by id, so this is effectively keyed by (stock id, method
+    id). Each value is a list of positions, because in rare cases multiple
+    entries for the same stock and method are executed on the same day. Each
+    position is an executed entry signal, where the entry signal is an instance
+    of the EntrySignal class.
+    The number of positions per stock and per method are counted, so that 
+    opening, closing, lookups and counts do not scan the positions.
+    The total SLR and ER of the positions are kept in a ledger for the current
+    date, because the equity models request them for every entry signal while
+    the positions do not change.
     '''
 
 
@@ -222,8 +233,42 @@ class Positions(object):
         Clears the positions. Use this to start a new system without generating
         a new Positions instance.
         '''
-        self.positions = []
+        self._positions = OrderedDict()
+        self._stocks = defaultdict(list)
+        self._n_method = defaultdict(int)
+        self._n_positions = 0
         self.max_positions = 0
+        self._clear_ledger()
+
+
+    def _clear_ledger(self, date=None):
+        '''
+        Clears the totals in the ledger and sets its date to <date>.
+        '''
+        self._ledger = {}
+        self._ledger_date = date
+
+
+    def _total(self, name, date, value):
+        '''
+        Returns the sum of <value>(position) for all positions. It is 
+        calculated once per <name> and <date>, the ledger is cleared if a 
+        position is opened or closed, or if the date changes.
+        '''
+        if date != self._ledger_date:
+            self._clear_ledger(date)
+        if name not in self._ledger:
+            self._ledger[name] = sum(value(p) for p in self.get())
+        return self._ledger[name]
+
+
+    @property
+    def positions(self):
+        '''
+        Returns a list with all positions in the order that they were opened.
+        '''
+        return [p for positions in self._positions.itervalues() for p in 
+                positions]
 
 
     def size(self, method=None):
@@ -232,9 +277,9 @@ class Positions(object):
         specified, only the positions for that <method> are counted.
         '''
         if method:
-            return sum(p.method == method for p in self.positions)
+            return self._n_method.get(method, 0)
         else:
-            return len(self.positions)
+            return self._n_positions
 
 
     def has(self, stock, method=None):
@@ -244,15 +289,15 @@ class Positions(object):
         considered.
         '''
         if method:
-            return stock in (p.stock for p in self.positions if 
-                                                            p.method == method)
+            return (stock, method) in self._positions
         else:
-            return stock in (p.stock for p in self.positions)
+            return stock in self._stocks
 
 
     def get(self):
         '''
-        Returns the positions as a list of positions.
+        Returns the positions as a list of positions. The list is a copy, so 
+        positions can be closed while iterating over it.
         '''
         return self.positions
 
@@ -262,7 +307,7 @@ class Positions(object):
         Returns the position (signal) of <stock>
 FIXME: AAD: what if multiple??
         '''
-        pos_list = [p for p in self.positions if p.stock == stock]
+        pos_list = self._stocks.get(stock, [])
         if len(pos_list) == 1:
             return pos_list[0]
         else:
@@ -273,32 +318,38 @@ FIXME: AAD: what if multiple??
         '''
         Opens a new position in the positions and returns the required cash.
         '''
-        self.positions.append(position)
+        key = (position.stock, position.method)
+        self._positions.setdefault(key, []).append(position)
+        self._stocks[position.stock].append(position)
+        self._n_method[position.method] += 1
+        self._n_positions += 1
+        self._clear_ledger()
         return position.cashflow()
 
 
-    def _index(self, stock, method=None):
-        '''
-        Returns the index of <stock> in <self.positions>. If <method> is 
-        specified, this must also be the method .
-        If <stock> is not found, None is returned
-        WARNING: the return value may be 0, so DO NOT USE this method to test
-        if <stock> is in the positions, use <positions.has()> for that.
-        '''
-        for i, position in enumerate(self.positions):
-            if position.is_for(stock, method):
-                return i
-
-
     def close_position(self, position):
         '''
         Closes a position in the positions and returns the cash result.
+        If there are multiple positions for the stock and method of <position>,
+        the one that was opened first is closed.
         '''
-        index = self._index(position.stock, position.method)
-        if index is None:
+        key = (position.stock, position.method)
+        if key not in self._positions:
             raise AttributeError, 'Attempt to exit position that is not in the'\
                     ' positions'
-        del self.positions[index]
+        positions = self._positions[key]
+        closed = positions.pop(0)
+        if not positions:
+            del self._positions[key]
+        stock_positions = self._stocks[position.stock]
+        stock_positions.remove(closed)
+        if not stock_positions:
+            del self._stocks[position.stock]
+        self._n_method[position.method] -= 1
+        if not self._n_method[position.method]:
+            del self._n_method[position.method]
+        self._n_positions -= 1
+        self._clear_ledger()
         return position.cashflow()
 
 
@@ -325,7 +376,7 @@ FIXME: AAD: what if multiple??
         '''
         self.max_positions = max(self.max_positions, self.size())
         value = 0
-        for position in self.positions:
+        for position in self.get():
             if position.method.direction == position.method.LONG:
                 value += position.volume * position.stock.price.close[date]
             else: #so it is short
@@ -339,7 +390,7 @@ FIXME: AAD: what if multiple??
         Return the sum of the Stop Loss Risk (SLR) of all positions.
         See <EntrySignal.stop_loss_risk> for definitions.
         '''
-        return sum(p.stop_loss_risk(date) for p in self.positions)
+        return self._total('slr', date, lambda p: p.stop_loss_risk(date))
 
 
     def equity_risk(self, date):
@@ -347,12 +398,12 @@ FIXME: AAD: what if multiple??
         Return the sum of the Equity Risk (ER) of all positions.
         See <EntrySignal.equity_risk> for definitions.
         '''
-        return sum(p.equity_risk(date) for p in self.positions)
+        return self._total('er', date, lambda p: p.equity_risk(date))
 
 
     def show(self):
-        print 'N=', len(self.positions)
-        for trade in self.positions:
+        print 'N=', self.size()
+        for trade in self.get():
             print trade.show()
 
 
@@ -360,7 +411,7 @@ FIXME: AAD: what if multiple??
         '''
         Writes <self.positions> to the <Trade> database table
         '''
-        Trade.write_to_db(self.positions, system)
+        Trade.write_to_db(self.get(), system)
 
 
 '''
@@ -368,11 +419,18 @@ The following table shows which properties of each of the Signal classes are
 (must be) available in each of the 4 signal 'modes'. Note that a positions
 position is an EntrySignal with some extra properties and a Trade is an 
 ExitSignal with some extra properties.
-<at> and <price> *only* exist for true signals.
+The mode is kept in <state>: an EntrySignal goes from SIGNAL to POSITION when
+it is executed, an ExitSignal goes from SIGNAL to TRADE. Setting <date_entry>
+or <date_exit> changes the state.
+<at> and <price> *only* exist for true signals (state SIGNAL), for positions
+and trades they raise an AttributeError.
+All signal classes use __slots__ (a backtest creates very many of them), so no
+other attributes can be set on them. <volume> is None until it is set.
 
                 Entry   Positions  Exit    Trade
                 Signal  position   Signal
 _BaseSignal
+    state          x        x        x        x
     stock          x        x        x        x
     method         x        x        x        x
     price          x        -        x        -
@@ -393,7 +451,16 @@ class _BaseSignal(object):
     '''
     Class with common methods and properties for the EntrySignal and ExitSignal
     classes.
+    The slots of all modes are defined here, the subclasses do not add any.
     '''
+    SIGNAL = 'signal'
+    POSITION = 'position'
+    TRADE = 'trade'
+
+    __slots__ = ('state', 'stock', 'method', 'rule_entry', '_price', '_at', 
+            'volume', 'price_entry', '_date_entry', 'rule_exit', 'price_exit',
+            '_date_exit')
+
 
     def __init__(self, stock, method, rule, at, price=None):
         '''
@@ -403,11 +470,13 @@ class _BaseSignal(object):
             raise ValueError('Price is not specified for a conditional entry.')
         if price and  (at == _Param.OPEN or at == _Param.CLOSE):
             raise ValueError('A price is specified for an unconditional entry')
+        self.state = self.SIGNAL
         self.stock = stock
         self.method = method
         self.rule_entry = rule
-        self.price = price
+        self._price = price
         self.at = at
+        self.volume = None
 
 
     @property
@@ -416,6 +485,8 @@ class _BaseSignal(object):
         Specify when this signal is to be executed: at the open, close, limit
         or stop. 
         '''
+        if self.state != self.SIGNAL:
+            raise AttributeError('at only exists for signals')
         return self._at
 
     @at.setter
@@ -429,6 +500,45 @@ class _BaseSignal(object):
         del self._at
 
 
+    @property
+    def price(self):
+        '''
+        The limit or stop price of a conditional signal, None for an 
+        unconditional signal.
+        '''
+        if self.state != self.SIGNAL:
+            raise AttributeError('price only exists for signals')
+        return self._price
+
+    @price.setter
+    def price(self, value):
+        self._price = value
+
+    @price.deleter
+    def price(self):
+        del self._price
+
+
+    @property
+    def date_entry(self):
+        return self._date_entry
+
+    @date_entry.setter
+    def date_entry(self, date):
+        self._date_entry = date
+        self.state = self.POSITION
+
+
+    @property
+    def date_exit(self):
+        return self._date_exit
+
+    @date_exit.setter
+    def date_exit(self, date):
+        self._date_exit = date
+        self.state = self.TRADE
+
+
     def is_unconditional(self):
         '''
         Returns true if the signal is unconditional.
@@ -448,28 +558,28 @@ class _BaseSignal(object):
         '''
         Returns true if the signal is an entry signal.
         '''
-        return not hasattr(self, 'date_entry')
+        return self.state == self.SIGNAL
 
 
     def is_exit_signal(self):
         '''
         Returns true if the signal is an exit signal.
         '''
-        return hasattr(self, 'rule_exit') and not hasattr(self, 'date_exit')
+        return False
 
 
     def is_position(self):
         '''
         Returns true if the signal is a Positions position.
         '''
-        return hasattr(self, 'date_entry') and not hasattr(self, 'rule_exit')
+        return self.state == self.POSITION
 
 
     def is_trade(self):
         '''
         Returns true if the signal is a trade.
         '''
-        return hasattr(self, 'date_exit')
+        return self.state == self.TRADE
 
 
     def is_for(self, stock, method=None):
@@ -513,20 +623,22 @@ class _BaseSignal(object):
         short exit  stop  : >= price (buy stop loss)
         short exit  limit : <= price (buy take profit)
         '''
-        if self.at == _Param.OPEN:
+        at = self.at
+        price = self.price
+        if at == _Param.OPEN:
             return self.stock.price.open.on(date)
-        elif self.at == _Param.CLOSE:
+        elif at == _Param.CLOSE:
             return self.stock.price.close.on(date)
         elif (self.method.direction == self.method.LONG) == (entry == (
-                self.at == _Param.LIMIT)):
+                at == _Param.LIMIT)):
             # LONG  entry: buy  <= limit price (buy up to)
             # LONG  exit:  sell <= stop price  (stop loss)
             # SHORT entry: sell <= stop price  (breakout)
             # SHORT exit:  buy  <= limit price (take profit)
             low = self.stock.price.low.on(date)
             open_ = self.stock.price.open.on(date)
-            return min(open_, self.price) if (low and open_ and 
-                    low < self.price) else None
+            return min(open_, price) if (low and open_ and 
+                    low < price) else None
         else:
             # LONG  exit:  sell >= limit price (take profit)
             # LONG  entry: buy  >= stop price  (breakout)
@@ -534,8 +646,8 @@ class _BaseSignal(object):
             # SHORT entry: sell >= limit price (buy up to)
             high = self.stock.price.high.on(date)
             open_ = self.stock.price.open.on(date)
-            return max(open_, self.price) if (high and open_ and 
-                    high > self.price) else None
+            return max(open_, price) if (high and open_ and 
+                    high > price) else None
 
 
     def show(self):
@@ -548,6 +660,63 @@ class _BaseSignal(object):
         return text
 
 
+class StopCache(object):
+    '''
+    Cache for the stops that EntrySignal.get_stop calculates. A stop only
+    depends on the stock, the method and the date (it is calculated for a
+    DummyPosition), so all entry signals and positions of a stock and method
+    share the cached stop of a date.
+    The cache must be cleared before each backtest (see MetaSystem._reset),
+    because the parameters of the methods change between runs.
+    '''
+
+    def __init__(self):
+        self.clear()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def clear(self):
+        '''
+        Remove all stops and reset the counters.
+        '''
+        self._data = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, stock, method, date, calculate):
+        '''
+        Returns the stop of <stock> and <method> on <date>. If it is not in the
+        cache, it is calculated by calling <calculate> (without arguments).
+        '''
+        key = (stock, method, date)
+        try:
+            stop = self._data[key]
+        except KeyError:
+            self.misses += 1
+            stop = self._data[key] = calculate()
+        else:
+            self.hits += 1
+        return stop
+
+
+    def stats(self):
+        '''
+        Returns a dict with the cache statistics.
+        '''
+        n_requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 
+                'n_items': len(self._data),
+                'hit_rate': self.hits / n_requests if n_requests else None}
+
+
+stop_cache = StopCache()
+
+
+
 class EntrySignal(_BaseSignal):
     '''
     Entry signal that may or may not be executed, depending on whether it is
@@ -555,10 +724,11 @@ class EntrySignal(_BaseSignal):
     If it is executed it becomes a positions position.
     '''
 
+    __slots__ = ()
+
     KEYLIST = ('stock', 'method', 'volume', 'rule_entry', 'price_entry', 
-            'date_entry', '_at', 'price')
+            'date_entry', 'at', 'price')
 
-    _stoploss = {} # cached value for get_stop
 
     def get_price(self, date):
         '''
@@ -585,8 +755,6 @@ class EntrySignal(_BaseSignal):
         if price:
             self.price_entry = price
             self.date_entry = date
-            del self.at
-            del self.price
             return True # entrysignal has now 'become' a position (so a 
                         #    position is an instance of an entrysignal
         return False
@@ -604,19 +772,23 @@ class EntrySignal(_BaseSignal):
     def get_stop(self, date):
         '''
         Return the stop(loss) value (price) for the trading day after <date>.
-        The value is cached to prevent multiple identical calculations.
+        The value is kept in the stop cache to prevent multiple identical 
+        calculations.
         '''
-        if date not in self._stoploss:
-            stop_loss = 0
-            dummy = DummyPosition(self.stock, self.method, date)
-            for exit_ in self.method.exits:
-                exit_signal = exit_.params.signal(date=date, position=dummy)
-                if exit_signal.at == _Param.STOP:
-                    stop_loss = max(stop_loss, exit_signal.price)
-            if not stop_loss:
-                raise ValueError('No stop loss is defined for this entry')
-            self._stoploss = {date: stop_loss}
-        return self._stoploss[date]
+        return stop_cache.get(self.stock, self.method, date, 
+                lambda: self._calc_stop(date))
+
+
+    def _calc_stop(self, date):
+        stop_loss = 0
+        dummy = DummyPosition(self.stock, self.method, date)
+        for exit_ in self.method.exits:
+            exit_signal = exit_.params.signal(date=date, position=dummy)
+            if exit_signal and exit_signal.at == _Param.STOP:
+                stop_loss = max(stop_loss, exit_signal.price)
+        if not stop_loss:
+            raise ValueError('No stop loss is defined for this entry')
+        return stop_loss
 
 
     def stop_loss_risk(self, date, volume=None):
@@ -629,10 +801,10 @@ class EntrySignal(_BaseSignal):
         using <self.price_entry> (which is not known yet).
         Note that SLR is a positive number.
         '''
-        if not volume and self.volume:
+        if not volume:
             volume = self.volume
-        else:
-            raise ValueError('volume not set for this signal/position')
+            if not volume:
+                raise ValueError('volume not set for this signal/position')
         stop_loss = self.get_stop(date)
         price = self.price_entry if self.is_position() else self.get_price(date)
         slr = volume * (price - stop_loss) if stop_loss < price else 0
@@ -646,22 +818,22 @@ class EntrySignal(_BaseSignal):
         stock would sell on the next day for its stop (loss) price.
         Note that ER is a positive number.
         '''
-        if not volume and self.volume:
+        if not volume:
             volume = self.volume
-        else:
-            raise ValueError('volume not set for this signal/position')
+            if not volume:
+                raise ValueError('volume not set for this signal/position')
         return volume * (self.stock.price.close[date] - self.get_stop(date))
 
 
 class DummyPosition(EntrySignal):
 
+    __slots__ = ()
+
     def __init__(self, stock, method, date):
         super(DummyPosition, self).__init__(stock, method, 'dummy', _Param.OPEN)
         self.price_entry = 0
         self.date_entry = date
         self.volume = 1
-        del self.at
-        del self.price
 
 
 class ExitSignal(_BaseSignal):
@@ -672,29 +844,46 @@ class ExitSignal(_BaseSignal):
     An exit signal is instantiated from a positions position.
     '''
 
+    __slots__ = ()
+
     KEYLIST = ('stock', 'method', 'volume', 'rule_entry', 
             'price_entry', 'date_entry', 'rule_exit', 'price_exit',
-            'date_exit', '_at', 'price')
+            'date_exit', 'at', 'price')
 
 
     def __init__(self, position, rule, at, price=None):
         '''
         Create the exit signal.
         '''
-        if not hasattr(position, 'volume'):
-            # If volume does not exist, <position> is an entry signal, so an
-            #  empty instance of ExitSignal is created to indicate that an exit
-            #  signal exists for this entry signal.
+        if position.volume is None:
+            # If volume is not set, <position> is an entry signal, so an empty
+            #  instance of ExitSignal (without a state) is created to indicate
+            #  that an exit signal exists for this entry signal.
             return
         super(ExitSignal, self).__init__(position.stock, position.method,
                 position.rule_entry, at, price)
         self.price_entry = position.price_entry
-        self.date_entry = position.date_entry
+        self._date_entry = position.date_entry # stays a SIGNAL
         self.rule_exit = rule
         # copy additional position properties:
         self.volume = position.volume
 
 
+    def is_entry_signal(self):
+        '''
+        Returns true if the signal is an entry signal, which an ExitSignal
+        never is.
+        '''
+        return False
+
+
+    def is_exit_signal(self):
+        '''
+        Returns true if the signal is an exit signal.
+        '''
+        return self.state == self.SIGNAL
+
+
     def n_days(self):
         '''
         Returns the number of days this trade was on the market.
@@ -742,8 +931,6 @@ class ExitSignal(_BaseSignal):
         if price:
             self.price_exit = price
             self.date_exit = date
-            del self.at
-            del self.price
             return True # exitsignal has now 'become' a trade, so a trade is
                         #    an instance of ExitSignal
         return False
@@ -772,7 +959,16 @@ class ExitSignal(_BaseSignal):
 
 class Signals(object):
     '''
-    This class manages the list of entry and exit signals.
+    This class manages the entry and exit signals.
+
+    The signals are kept in a signal book: an entry and an exit container, 
+    each an ordered dict keyed by (stock, method) with the list of signals for
+    that stock and method, so conditional signals can be removed without
+    scanning all signals.
+    The entries that have their volume set (see set_volume) are kept in a list,
+    the totals of their cash, SLR and ER are updated incrementally as entries
+    are added to it, so that the equity models do not recalculate them for
+    each entry signal.
     '''
 
     def __init__(self):
@@ -787,7 +983,20 @@ class Signals(object):
         Clears the positions. Use this to start a new system without generating
         a new Positions instance.
         '''
-        self.signals = []
+        self._entries = OrderedDict()
+        self._exits = OrderedDict()
+        self._executable = []
+        self._unconditional_exits = []
+        self._n_unconditional_exits = defaultdict(int)
+        self._totals = {}
+
+
+    @property
+    def signals(self):
+        '''
+        Return a list with all exit signals followed by all entry signals
+        '''
+        return self.exits + self.entries
 
 
     @property
@@ -795,7 +1004,7 @@ class Signals(object):
         '''
         Return the list of exit signals
         '''
-        return [s for s in self.signals if s.is_exit_signal()]
+        return [s for signals in self._exits.itervalues() for s in signals]
 
 
     @property
@@ -803,7 +1012,21 @@ class Signals(object):
         '''
         Return a list with all entry signals
         '''
-        return [s for s in self.signals if s.is_entry_signal()]
+        return [s for signals in self._entries.itervalues() for s in signals]
+
+
+    def _add(self, book, signal):
+        '''
+        Add <signal> to the entry or exit container <book>. If it is 
+        unconditional, the conditional signals for the same stock and method 
+        are removed.
+        '''
+        key = (signal.stock, signal.method)
+        if signal.is_unconditional():
+            book[key] = [s for s in book.get(key, []) if 
+                    s.is_unconditional()] + [signal]
+        else:
+            book.setdefault(key, []).append(signal)
 
 
     def set_entries(self, date, method, pool, positions):
@@ -829,9 +1052,8 @@ class Signals(object):
                         break   # one exit signal suffices to discard the entry
                 if not signal:
                     continue
-                self.signals.append(signal)
+                self._add(self._entries, signal)
                 if signal.is_unconditional():
-                    self._remove_conditional_signals(self.entries, stock, method)
                     break # prevent multiple entries with the same method
 
 
@@ -851,10 +1073,10 @@ class Signals(object):
                         ranked_stock_list=method.get_ranked_stocklist(date, 
                         pool), method_list=method_list)
                 if signal:
-                    self.signals.append(signal)
+                    self._add(self._exits, signal)
                     if signal.is_unconditional():
-                        self._remove_conditional_signals(self.exits, 
-                                position.stock, method)
+                        self._unconditional_exits.append(signal)
+                        self._n_unconditional_exits[method] += 1
                         break # no need for other exits for this stock
 
 
@@ -876,16 +1098,31 @@ class Signals(object):
                 break # for all remaining entry signals volume = 0 so they
                     # will be ignored
             entry_signal.volume = volume
+            self._executable.append(entry_signal)
         self._remove_empty_entries()
 
 
+    def _total(self, name, date, signals, value):
+        '''
+        Returns the sum of <value>(signal) for the list <signals>, which may 
+        only be appended to. The total is kept per <name> and <date>, so only
+        the signals that were appended after the previous call are added.
+        '''
+        key = (name, date)
+        n_counted, total = self._totals.get(key, (0, 0))
+        for signal in signals[n_counted:]:
+            total += value(signal)
+        self._totals[key] = (len(signals), total)
+        return total
+
+
     def entries_cash(self, date):
         '''
         Returns the (estimated) required cash to enter all entry signals that 
         have their volume set. These may be conditional or unconditional.
         '''
-        return sum((n.volume * n.get_price(date) for n in self.entries if 
-                hasattr(n, 'volume')))
+        return self._total('cash', date, self._executable, 
+                lambda n: n.volume * n.get_price(date))
 
 
     def exits_cash(self, date):
@@ -893,8 +1130,8 @@ class Signals(object):
         Returns an estimate of cash that would be freed up by all unconditional
         exit signals.
         '''
-        return sum((x.volume * x.get_price(date) for x in self.exits if 
-                x.is_unconditional()))
+        return self._total('exits_cash', date, self._unconditional_exits, 
+                lambda x: x.volume * x.get_price(date))
 
 
     def stop_loss_risk(self, date):
@@ -903,11 +1140,8 @@ class Signals(object):
         have their volume set.
         See <EntrySignal.stop_loss_risk> for definitions.
         '''
-        slr = 0
-        for entry_signal in self.entries:
-            if entry_signal.volume:
-                slr += entry_signal.stop_loss_risk(date)
-        return slr
+        return self._total('slr', date, self._executable, 
+                lambda n: n.stop_loss_risk(date))
 
 
     def equity_risk(self, date):
@@ -916,20 +1150,20 @@ class Signals(object):
         their volume set.
         See <EntrySignal.equity_risk> for definitions.
         '''
-        er = 0
-        for entry_signal in self.entries:
-            if entry_signal.volume:
-                er += entry_signal.equity_risk(date)
-        return er
+        return self._total('er', date, self._executable, 
+                lambda n: n.equity_risk(date))
 
 
     def _remove_empty_entries(self):
         '''
         Remove all entry signals from the list that have no volume.
         '''
-        for entry_signal in reversed(self.entries):
-            if not hasattr(entry_signal, 'volume'):
-                self.signals.remove(entry_signal)
+        for key, signals in self._entries.items():
+            signals = [s for s in signals if s.volume is not None]
+            if signals:
+                self._entries[key] = signals
+            else:
+                del self._entries[key]
 
 
     def trade(self, date, positions, equity):
@@ -953,20 +1187,11 @@ class Signals(object):
         return trades
 
 
-    def _remove_conditional_signals(self, signals, stock, method):
-        '''
-        Remove existing conditional <signals> (entries or exits) for <position>
-        '''
-        for signal in reversed(signals):
-            if signal.is_conditional() and signal.is_for(stock, method):
-                self.signals.remove(signal)
-
-
     def count_executable_entries(self):
         '''
         Return the number of entries that have their volume set.
         '''
-        return len([n for n in self.entries if hasattr(n, 'volume')])
+        return len(self._executable)
 
 
     def count_unconditional_exits(self, method=None):
@@ -974,7 +1199,6 @@ class Signals(object):
         Return the number of unconditional exit signals.
         '''
         if method:
-            return sum(1 for s in self.exits if s.is_unconditional() and 
-                    s.method == method)
+            return self._n_unconditional_exits.get(method, 0)
         else:
-            return sum(1 for s in self.exits if s.is_unconditional())
+            return len(self._unconditional_exits)
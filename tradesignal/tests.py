@@ -1,13 +1,414 @@
 from __future__ import division
 from __future__ import absolute_import
 
-from datetime import date
+from datetime import date, timedelta
+from collections import defaultdict
 
 from django.test import TestCase
 
 from pricemanager.models import Stock
+from pricemanager.indicators.multi import StockPrices
 
-from tradesignal.models import _BaseSignal, EntrySignal, ExitSignal
+from metasystem.parameters.fields import _Param
+from tradesignal.models import _BaseSignal, EntrySignal, ExitSignal,\
+        Positions, Signals, StopCache, stop_cache, DummyPosition
+
+
+class StubStock(object):
+    '''
+    Stock with prices but without the database. The close prices <closes> are
+    on consecutive days from <startdate>, the open is 1 below the close, the
+    high 2 above and the low 3 below.
+    '''
+    def __init__(self, name, closes, startdate=date(2012,6,4)):
+        self.name = name
+        self.price = StockPrices(self)
+        self.price.load([(startdate + timedelta(days=i), c - 1., c + 2., 
+                c - 3., c, 1000) for i, c in enumerate(closes)])
+
+
+class StubMethod(object):
+    '''
+    Long method with the entry rules <entries> and exit rules <exits> that
+    ranks <stocks> in the given order.
+    '''
+    LONG = 1
+
+    def __init__(self, entries=(), exits=(), stocks=()):
+        self.direction = self.LONG
+        self.entries = list(entries)
+        self.exits = list(exits)
+        self.stocks = list(stocks)
+
+    def get_ranked_stocklist(self, date, pool):
+        return [(stock, None, True) for stock in self.stocks]
+
+
+class StubEntry(object):
+    '''
+    Entry rule that gives an entry signal at <at> (and <price>) for every
+    stock.
+    '''
+    can_prevent_entry = False
+
+    def __init__(self, at, price=None):
+        self.params = self
+        self.at = at
+        self.price = price
+
+    def signal(self, date, stock, method):
+        return EntrySignal(stock, method, 'stub', self.at, self.price)
+
+
+class StubStop(object):
+    '''
+    Exit rule with a stop loss at a fixed <price>, it counts how often it
+    gives a signal in <n_calls>.
+    '''
+    can_prevent_entry = False
+
+    def __init__(self, price):
+        self.params = self
+        self.price = price
+        self.n_calls = 0
+
+    def signal(self, date, position, **kwargs):
+        self.n_calls += 1
+        return ExitSignal(position, 'stub', _Param.STOP, self.price)
+
+
+class StubSizing(object):
+    '''
+    Allocation and equity model in one: every entry gets <volume>, until the
+    cash of the entries would exceed <max_cash>. The totals that the Signals
+    report to adjust_volume are kept in <totals>.
+    '''
+
+    def __init__(self, volume, max_cash):
+        self.volume = volume
+        self.max_cash = max_cash
+        self.totals = []
+
+    def size(self, date, entry_signal, total_equity):
+        return self.volume
+
+    def adjust_volume(self, date, signals, volume, entrysignal, **kwargs):
+        cash = signals.entries_cash(date)
+        self.totals.append((cash, signals.stop_loss_risk(date), 
+                signals.equity_risk(date)))
+        if cash + volume * entrysignal.get_price(date) > self.max_cash:
+            return 0
+        return volume
+
+
+class StubEquity(object):
+    '''
+    Equity with a fixed total and cash on every date.
+    '''
+
+    def __init__(self, total):
+        self.total = defaultdict(lambda: total)
+        self.cash = self.total
+
+
+class StubPosition(object):
+    '''
+    Open position with a fixed SLR and ER, it counts how often they are
+    calculated in <n_calls>.
+    '''
+
+    def __init__(self, stock, method, slr, er):
+        self.stock = stock
+        self.method = method
+        self.slr = slr
+        self.er = er
+        self.n_calls = 0
+
+    def cashflow(self):
+        return 0
+
+    def stop_loss_risk(self, date):
+        self.n_calls += 1
+        return self.slr
+
+    def equity_risk(self, date):
+        self.n_calls += 1
+        return self.er
+
+
+class SignalStubTests(TestCase):
+    '''
+    Tests of signals and positions on stub stocks, so they do not need the
+    PriceData fixture.
+    '''
+
+    def setUp(self):
+        self.aapl = StubStock('AAPL', [580., 575., 585., 590., 570.])
+        self.intc = StubStock('INTC', [26., 27., 25., 26., 28.])
+        self.testdate = date(2012,6,5)
+
+    def test_Positions(self):
+        m2, m3 = StubMethod(), StubMethod()
+        signals = []
+        for stock, method in ((self.aapl, m2), (self.intc, m2), (self.aapl, m3),
+                (self.aapl, m2)):
+            es = EntrySignal(stock, method, 1, _Param.OPEN)
+            self.assertTrue(es.execute(self.testdate))
+            es.volume = 10
+            signals.append(es)
+        positions = Positions()
+        for es in signals:
+            self.assertEqual(positions.open_position(es), 
+                    -10 * es.price_entry)
+        self.assertEqual(positions.size(), 4)
+        self.assertEqual(positions.size(m2), 3)
+        self.assertEqual(positions.size(StubMethod()), 0)
+        self.assertTrue(positions.has(self.aapl, m3))
+        self.assertFalse(positions.has(self.intc, m3))
+        self.assertTrue(positions.has(self.intc))
+        self.assertEqual(positions.get(), [signals[0], signals[3], 
+                signals[1], signals[2]])
+        self.assertIs(positions.get_position(self.intc), signals[1])
+        self.assertRaises(ValueError, positions.get_position, self.aapl)
+        positions.close_position(signals[3]) # closes the first (aapl, 2)
+        self.assertEqual(positions.get(), signals[3:] + signals[1:3])
+        self.assertEqual(positions.size(m2), 2)
+        self.assertTrue(positions.has(self.aapl, m2))
+        positions.close_position(signals[0])
+        self.assertFalse(positions.has(self.aapl, m2))
+        self.assertIs(positions.get_position(self.aapl), signals[2])
+        self.assertRaises(AttributeError, positions.close_position, 
+                signals[0])
+        trades = positions.close_all(date(2012,6,30))
+        self.assertEqual(len(trades), 2)
+        self.assertEqual([t.price_exit for t in trades], [28., 570.])
+        self.assertTrue(all(t.is_trade() for t in trades))
+        self.assertEqual(positions.size(), 0)
+        self.assertEqual(positions.size(m2), 0)
+        self.assertFalse(positions.has(self.intc))
+
+    def test_Signals_book(self):
+        limit = StubEntry(_Param.LIMIT, 560.)
+        stop = StubEntry(_Param.STOP, 600.)
+        m_cond = StubMethod([limit, stop], stocks=[self.aapl, self.intc])
+        m_open = StubMethod([limit, StubEntry(_Param.OPEN), stop], 
+                stocks=[self.intc, self.aapl])
+        signals = Signals()
+        positions = Positions()
+        signals.set_entries(self.testdate, m_cond, None, positions)
+        signals.set_entries(self.testdate, m_open, None, positions)
+        self.assertEqual([(s.stock, s.method, s.at) for s in 
+                signals.entries], [
+                (self.aapl, m_cond, _Param.LIMIT), 
+                (self.aapl, m_cond, _Param.STOP),
+                (self.intc, m_cond, _Param.LIMIT), 
+                (self.intc, m_cond, _Param.STOP),
+                (self.intc, m_open, _Param.OPEN), 
+                (self.aapl, m_open, _Param.OPEN)])
+        self.assertEqual(signals.exits, [])
+        self.assertEqual(signals.signals, signals.entries)
+        # an unconditional signal replaces the conditional signals of its 
+        #   stock and method, but not those of other methods
+        signals._add(signals._entries, EntrySignal(self.aapl, m_cond, 'x', 
+                _Param.CLOSE))
+        self.assertEqual([(s.stock, s.method, s.at) for s in 
+                signals.entries][:3], [
+                (self.aapl, m_cond, _Param.CLOSE),
+                (self.intc, m_cond, _Param.LIMIT), 
+                (self.intc, m_cond, _Param.STOP)])
+        signals.clear()
+        self.assertEqual(signals.signals, [])
+
+    def test_Signals_volume(self):
+        method = StubMethod([StubEntry(_Param.OPEN)], [StubStop(500.)], 
+                stocks=[self.aapl, self.intc, StubStock('MSFT', [30.] * 5), 
+                StubStock('GOOG', [600.] * 5)])
+        signals = Signals()
+        signals.set_entries(self.testdate, method, None, Positions())
+        entries = signals.entries
+        sizing = StubSizing(10, 6500.)
+        signals.set_volume(self.testdate, sizing, StubEquity(10000.), sizing,
+                Positions())
+        # the totals that the equity model sees include exactly the entries
+        #   that were accepted before
+        self.assertEqual(len(sizing.totals), 4)
+        for n_accepted, totals in enumerate(sizing.totals):
+            accepted = entries[:n_accepted]
+            self.assertEqual(totals, (
+                    sum(10 * e.get_price(self.testdate) for e in accepted),
+                    sum(e.stop_loss_risk(self.testdate) for e in accepted),
+                    sum(e.equity_risk(self.testdate) for e in accepted)))
+        # GOOG did not fit, so it has no volume and it is dropped
+        self.assertEqual(signals.entries, entries[:3])
+        self.assertEqual([getattr(e, 'volume', None) for e in entries], 
+                [10, 10, 10, None])
+        self.assertEqual(signals.count_executable_entries(), 3)
+        self.assertEqual(signals.entries_cash(self.testdate), 
+                10 * (575. + 27. + 30.))
+        self.assertEqual(signals.entries_cash(date(2012,6,6)), 
+                10 * (585. + 25. + 30.))
+        # the stop is above the price of INTC and MSFT, so only AAPL has SLR
+        self.assertEqual(signals.stop_loss_risk(self.testdate), 
+                10 * (575. - 500.))
+        self.assertEqual(signals.equity_risk(self.testdate), 
+                10 * (575. + 27. + 30. - 3 * 500.))
+
+    def test_Positions_ledger(self):
+        method = StubMethod()
+        aapl = StubPosition('AAPL', method, 140., 150.)
+        msft = StubPosition('MSFT', method, 60., 70.)
+        positions = Positions()
+        positions.open_position(aapl)
+        self.assertEqual(positions.stop_loss_risk(self.testdate), 140.)
+        self.assertEqual(positions.stop_loss_risk(self.testdate), 140.)
+        self.assertEqual(aapl.n_calls, 1)
+        self.assertEqual(positions.equity_risk(self.testdate), 150.)
+        self.assertEqual(positions.equity_risk(self.testdate), 150.)
+        self.assertEqual(aapl.n_calls, 2)
+        # opening and closing positions clears the ledger
+        positions.open_position(msft)
+        self.assertEqual(positions.stop_loss_risk(self.testdate), 200.)
+        self.assertEqual((aapl.n_calls, msft.n_calls), (3, 1))
+        positions.close_position(aapl)
+        self.assertEqual(positions.stop_loss_risk(self.testdate), 60.)
+        self.assertEqual(positions.equity_risk(self.testdate), 70.)
+        self.assertEqual((aapl.n_calls, msft.n_calls), (3, 3))
+        # a new date starts a new ledger
+        self.assertEqual(positions.stop_loss_risk(date(2012,6,6)), 60.)
+        self.assertEqual(positions.stop_loss_risk(date(2012,6,6)), 60.)
+        self.assertEqual(msft.n_calls, 4)
+
+
+class StopCacheTests(TestCase):
+
+    def setUp(self):
+        stop_cache.clear()
+
+    def test_StopCache(self):
+        cache = StopCache()
+        calls = []
+        def calculate():
+            calls.append(1)
+            return 570.
+        for unused in range(3):
+            self.assertEqual(cache.get('AAPL', 2, date(2012,6,11), 
+                    calculate), 570.)
+        self.assertEqual(cache.get('AAPL', 3, date(2012,6,11), calculate),
+                570.)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 2, 
+                'n_items': 2, 'hit_rate': 0.5})
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.stats()['hit_rate'])
+
+    def test_get_stop(self):
+        aapl = StubStock('AAPL', [580., 575., 585.])
+        stop = StubStop(560.)
+        method = StubMethod(exits=[stop])
+        testdate = date(2012,6,5)
+        signals = [EntrySignal(aapl, method, rule, _Param.OPEN) for rule in 
+                (1, 2)]
+        self.assertEqual([s.get_stop(testdate) for s in signals], [560.,560.])
+        self.assertEqual(stop.n_calls, 1)
+        self.assertEqual(signals[0].get_stop(date(2012,6,6)), 560.)
+        self.assertEqual(stop.n_calls, 2)
+        other = EntrySignal(aapl, StubMethod(exits=[stop]), 1, _Param.OPEN)
+        self.assertEqual(other.get_stop(testdate), 560.)
+        self.assertEqual(stop.n_calls, 3)
+        self.assertEqual(stop_cache.stats()['hits'], 1)
+
+
+class SignalStateTests(TestCase):
+    '''
+    Tests of the state (signal, position or trade) of the signal classes.
+    '''
+
+    def setUp(self):
+        self.aapl = StubStock('AAPL', [580., 575., 585., 590., 570.])
+        self.method = StubMethod(exits=[StubStop(560.)])
+        self.testdate = date(2012,6,5)
+        stop_cache.clear()
+
+    def test_slots(self):
+        es = EntrySignal(self.aapl, self.method, 3, _Param.CLOSE)
+        self.assertFalse(hasattr(es, '__dict__'))
+        with self.assertRaises(AttributeError):
+            es.buydelay = 1
+        self.assertIsNone(es.volume)
+        self.assertRaises(AttributeError, getattr, es, 'date_entry')
+        self.assertRaises(AttributeError, getattr, es, 'price_entry')
+        dummy = DummyPosition(self.aapl, self.method, self.testdate)
+        self.assertFalse(hasattr(dummy, '__dict__'))
+        self.assertEqual(dummy.state, dummy.POSITION)
+        self.assertTrue(dummy.is_position())
+        self.assertRaises(AttributeError, getattr, dummy, 'at')
+
+    def test_entry_state(self):
+        es = EntrySignal(self.aapl, self.method, 3, _Param.LIMIT, 570.)
+        self.assertEqual(es.state, es.SIGNAL)
+        self.assertTrue(es.is_entry_signal())
+        self.assertFalse(es.is_exit_signal())
+        self.assertTrue(es.is_conditional())
+        self.assertEqual(es.get_price(self.testdate), 570.)
+        self.assertFalse(es.execute(self.testdate)) # low is 572
+        self.assertEqual(es.state, es.SIGNAL)
+        self.assertEqual((es.at, es.price), (_Param.LIMIT, 570.))
+        self.assertTrue(es.execute(date(2012,6,8))) # open 569, low 567
+        self.assertEqual(es.state, es.POSITION)
+        self.assertEqual((es.price_entry, es.date_entry), (569., 
+                date(2012,6,8)))
+        self.assertFalse(es.is_entry_signal())
+        self.assertTrue(es.is_position())
+        self.assertFalse(es.is_trade())
+        # at and price are kept in their slots, but only signals have them
+        self.assertRaises(AttributeError, getattr, es, 'at')
+        self.assertRaises(AttributeError, getattr, es, 'price')
+        self.assertRaises(AttributeError, es.is_unconditional)
+        self.assertRaises(AttributeError, es.get_price, self.testdate)
+        self.assertRaises(AttributeError, es.execute, self.testdate)
+        self.assertEqual(es.get_data()['price_entry'], 569.)
+        self.assertNotIn(_Param.LIMIT, es.show())
+        # setting date_entry makes a position
+        position = EntrySignal(self.aapl, self.method, 3, _Param.CLOSE)
+        position.volume = 1
+        position.price_entry = 580.
+        position.date_entry = date(2012,6,4)
+        self.assertTrue(position.is_position())
+        self.assertRaises(AttributeError, getattr, position, 'price')
+
+    def test_exit_state(self):
+        es = EntrySignal(self.aapl, self.method, 3, _Param.OPEN)
+        empty = ExitSignal(es, 4, _Param.OPEN)
+        self.assertTrue(empty)
+        self.assertFalse(hasattr(empty, 'state'))
+        self.assertRaises(AttributeError, empty.is_exit_signal)
+        self.assertTrue(es.execute(self.testdate))
+        es.volume = 10
+        xs = ExitSignal(es, 4, _Param.STOP, 571.)
+        self.assertEqual(xs.state, xs.SIGNAL)
+        self.assertEqual(es.state, es.POSITION)
+        self.assertTrue(xs.is_exit_signal())
+        self.assertFalse(xs.is_entry_signal())
+        self.assertFalse(xs.is_position())
+        self.assertEqual((xs.date_entry, xs.price_entry, xs.volume), 
+                (self.testdate, 574., 10))
+        self.assertEqual(xs.get_price(self.testdate), 571.)
+        self.assertFalse(xs.execute(date(2012,6,7))) # low 587
+        self.assertEqual(xs.state, xs.SIGNAL)
+        self.assertTrue(xs.execute(date(2012,6,8))) # open 569, low 567
+        self.assertEqual(xs.state, xs.TRADE)
+        self.assertTrue(xs.is_trade())
+        self.assertFalse(xs.is_exit_signal())
+        self.assertEqual((xs.price_exit, xs.date_exit), (569., 
+                date(2012,6,8)))
+        self.assertRaises(AttributeError, getattr, xs, 'price')
+        self.assertRaises(AttributeError, getattr, xs, 'at')
+        self.assertEqual(xs.n_days(), 3)
+        self.assertAlmostEqual(xs.gain(), 569. / 574.)
+        data = xs.get_data()
+        self.assertEqual((data['volume'], data['price_exit'], 
+                data['rule_exit']), (10, 569., 4))
 
 
 class TestSignal(TestCase):